@@ -0,0 +1,261 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import http.server
+import click
+
+INSTALL_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "install.py")
+
+# Stand-in for the conda CLI: just enough of create/install/list/remove/shell.posix for install.py,
+# with a configurable sleep standing in for the solver
+FAKE_CONDA = r'''#!{python}
+import os, sys, json, time, shutil
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+args = sys.argv[1:]
+solve = float(os.environ.get("FAKE_CONDA_SOLVE_SECONDS", "0.2"))
+
+def option(flag):
+    return args[args.index(flag) + 1] if flag in args else None
+
+def positional():
+    values, skip = [], False
+    for arg in args[1:]:
+        if skip:
+            skip = False
+        elif arg in ("--name", "-n", "-c", "--file", "--clone", "-p"):
+            skip = True
+        elif not arg.startswith("-"):
+            values.append(arg)
+    return values
+
+def env_prefix(name):
+    return root if name == "base" else os.path.join(root, "envs", name)
+
+def add_packages(prefix, packages):
+    meta = os.path.join(prefix, "conda-meta")
+    os.makedirs(meta, exist_ok=True)
+    os.makedirs(os.path.join(prefix, "bin"), exist_ok=True)
+    for package in packages:
+        name = package.split("=")[0].split("/")[-1]
+        with open(os.path.join(meta, f"{{name}}-1.0-0.json"), "w") as f:
+            json.dump({{"name": name, "version": "1.0", "files": []}}, f)
+    with open(os.path.join(meta, "history"), "a") as f:
+        f.write(f"==> {{time.time()}} <==\n# cmd: conda {{' '.join(args)}}\n")
+
+command = args[0] if args else ""
+if command == "shell.posix" and args[1] == "deactivate":
+    print("export CONDA_PREFIX=''")
+    print("export CONDA_SHLVL='0'")
+elif command == "shell.posix":
+    prefix = args[2]
+    print(f"PS1='({{os.path.basename(prefix)}}) {{os.environ.get('PS1', '')}}'")
+    print(f"export PATH='{{prefix}}/bin:{{os.environ['PATH']}}'")
+    print(f"export CONDA_PREFIX='{{prefix}}'")
+elif command == "create":
+    prefix = env_prefix(option("--name"))
+    if option("--file"):
+        time.sleep(solve / 10)
+        with open(option("--file")) as f:
+            add_packages(prefix, [line.rsplit("/", 1)[-1].split("-1.0-0")[0] for line in f if line.startswith("http")])
+    elif option("--clone"):
+        time.sleep(solve / 10)
+        shutil.copytree(option("--clone"), prefix)
+    else:
+        time.sleep(solve)
+        add_packages(prefix, ["python=3.11"] + positional())
+elif command == "install":
+    time.sleep(solve)
+    add_packages(env_prefix(option("--name")), positional())
+elif command == "list" and "--explicit" in args:
+    print("@EXPLICIT")
+    for record in sorted(os.listdir(os.path.join(env_prefix(option("--name")), "conda-meta"))):
+        if record.endswith(".json"):
+            print(f"https://conda.example/linux-64/{{record[:-5]}}.conda#0")
+elif command == "remove":
+    shutil.rmtree(env_prefix(option("--name")), ignore_errors=True)
+'''
+
+# Stand-in for the Miniconda installer: lays down a prefix with the fake conda, followed by padding
+# so downloads move a realistic amount of data
+FAKE_INSTALLER = '''#!/bin/bash
+while [ $# -gt 0 ]; do [ "$1" = "-p" ] && PREFIX="$2"; shift; done
+mkdir -p "$PREFIX/bin" "$PREFIX/condabin" "$PREFIX/conda-meta" "$PREFIX/pkgs" "$PREFIX/lib"
+cat > "$PREFIX/bin/conda" <<'FAKE_CONDA_EOF'
+{fake_conda}
+FAKE_CONDA_EOF
+chmod +x "$PREFIX/bin/conda"
+touch "$PREFIX/conda-meta/history" "$PREFIX/conda-meta/python-3.11.0-0.json"
+for i in $(seq 1 {files}); do echo "$i" > "$PREFIX/lib/file$i.py"; done
+exit 0
+'''
+
+# Benchmark scenarios: name, install.py arguments and the stdin fed to its prompts
+SCENARIOS = [
+    ("install_cold", [], "yes\n5\n"),
+    ("list_envs", [], "1\n1\n"),
+    ("spec_cold", ["--spec", "{spec}"], ""),
+    ("spec_warm_locks", ["--spec", "{spec2}"], ""),
+    ("reinstall_warm_cache", [], "3\nn\n"),
+    ("uninstall", [], "4\ny\n"),
+]
+
+
+# Function to serve a directory over HTTP with Range support, standing in for the installer mirror
+def start_mirror(directory):
+    class RangeHandler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def send_head(self):
+            path = self.translate_path(self.path)
+            match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+            if os.path.isdir(path) or not match:
+                return super().send_head()
+            f = open(path, "rb")
+            size = os.fstat(f.fileno()).st_size
+            start, end = int(match.group(1)), min(int(match.group(2)), size - 1)
+            f.seek(start)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            return RangeReader(f, end - start + 1)
+
+        def end_headers(self):
+            self.send_header("Accept-Ranges", "bytes")
+            super().end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# File wrapper that stops after a fixed number of bytes, used to answer range requests
+class RangeReader:
+    def __init__(self, f, remaining):
+        self.f, self.remaining = f, remaining
+
+    def read(self, size=-1):
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+# Function to build the fake installer, its index page and two spec files in a scratch directory
+def build_fixtures(workdir, installer_mb, files, envs):
+    mirror_dir = os.path.join(workdir, "mirror")
+    os.makedirs(mirror_dir)
+    installer = FAKE_INSTALLER.format(fake_conda=FAKE_CONDA.format(python=sys.executable), files=files).encode()
+    installer += os.urandom(installer_mb * 1024 * 1024)
+    installer_path = os.path.join(mirror_dir, "Miniconda3-latest-Linux-x86_64.sh")
+    with open(installer_path, "wb") as f:
+        f.write(installer)
+    digest = hashlib.sha256(installer).hexdigest()
+    with open(os.path.join(mirror_dir, "index.html"), "w") as f:
+        f.write(f'<tr><td><a href="Miniconda3-latest-Linux-x86_64.sh">installer</a></td><td>{digest}</td></tr>\n')
+
+    # The second spec repeats the first under new names, so every create should hit the lockfile cache
+    specs = {}
+    for key, prefix in (("spec", "env"), ("spec2", "again")):
+        specs[key] = os.path.join(workdir, f"{key}.json")
+        with open(specs[key], "w") as f:
+            json.dump({"environments": [
+                {"name": f"{prefix}{i}", "python": "3.11", "packages": ["numpy", f"pkg{i % 3}"]} for i in range(envs)
+            ]}, f)
+    return specs
+
+
+# Function to run one scenario through the real install.py CLI and collect its wall time and spans
+def run_scenario(name, args, stdin, home, env):
+    trace_path = os.path.join(home, f"trace-{name}.json")
+    command = [sys.executable, INSTALL_PY, "--trace", trace_path, *args]
+    started = time.perf_counter()
+    result = subprocess.run(command, input=stdin, env=env, cwd=home, text=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    wall = time.perf_counter() - started
+    if result.returncode != 0:
+        raise click.ClickException(f"Scenario {name} failed (exit {result.returncode}):\n{result.stdout}")
+    phases = {}
+    with open(trace_path, "r") as f:
+        for span in json.load(f)["spans"]:
+            phases[span["name"]] = phases.get(span["name"], 0) + span["duration"]
+    return {"wall": wall, "phases": phases}
+
+
+# Function to flag scenarios and phases that got slower than the baseline by more than the threshold
+def find_regressions(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        pairs = [("wall", result["wall"], previous["wall"])]
+        pairs += [(phase, seconds, previous["phases"][phase]) for phase, seconds in result["phases"].items() if phase in previous["phases"]]
+        for label, current, before in pairs:
+            # Ignore tiny absolute changes, they are noise at this scale
+            if current > before * (1 + threshold) and current - before > 0.05:
+                regressions.append(f"{name} {label}: {before:.3f}s -> {current:.3f}s (+{(current / before - 1) * 100:.0f}%)")
+    return regressions
+
+
+@click.command()
+@click.option("--installer-mb", default=32, show_default=True, help="Size of the fake installer served by the local mirror.")
+@click.option("--files", default=2000, show_default=True, help="Number of files the fake installer lays down.")
+@click.option("--envs", default=10, show_default=True, help="Number of environments in the spec scenarios.")
+@click.option("--solve-seconds", default=0.2, show_default=True, help="Time the fake conda spends 'solving' each create/install.")
+@click.option("--results", "results_path", default="bench-results.json", show_default=True, help="Where results are saved; the previous file is the baseline.")
+@click.option("--threshold", default=0.2, show_default=True, help="Relative slowdown reported as a regression.")
+def main(installer_mb, files, envs, solve_seconds, results_path, threshold):
+    workdir = tempfile.mkdtemp(prefix="conda-setup-bench-")
+    try:
+        home = os.path.join(workdir, "home")
+        os.makedirs(home)
+        specs = build_fixtures(workdir, installer_mb, files, envs)
+        server = start_mirror(os.path.join(workdir, "mirror"))
+        env = {
+            "HOME": home,
+            # The installed prefix is on PATH, as the rc hook would put it there in a real shell
+            "PATH": f"{home}/miniconda/bin:{os.path.dirname(sys.executable)}:/usr/bin:/bin",
+            "CONDA_SETUP_INSTALLER_URL": f"http://127.0.0.1:{server.server_port}/Miniconda3-latest-Linux-x86_64.sh",
+            "FAKE_CONDA_SOLVE_SECONDS": str(solve_seconds),
+        }
+
+        results = {}
+        for name, args, stdin in SCENARIOS:
+            args = [arg.format(**specs) for arg in args]
+            results[name] = run_scenario(name, args, stdin, home, env)
+            phases = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in sorted(results[name]["phases"].items()))
+            click.echo(f"{name:<22} {results[name]['wall']:7.3f}s  {phases}")
+        server.shutdown()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(results_path):
+        with open(results_path, "r") as f:
+            baseline = json.load(f)["results"]
+    with open(results_path, "w") as f:
+        json.dump({"time": time.time(), "results": results}, f, indent=2, sort_keys=True)
+
+    regressions = find_regressions(results, baseline, threshold)
+    for regression in regressions:
+        click.echo(f"REGRESSION {regression}")
+    if regressions:
+        raise SystemExit(1)
+    click.echo("No regressions." if baseline else f"Saved baseline to {results_path}.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import io
+import os
+import sys
+import json
+import fcntl
+import contextlib
+import socketserver
+
+# This module runs under the Conda base environment's own Python so it can import conda once and
+# keep it loaded. It only uses the standard library and conda, since click is not installed there.
+
+
+# Function to run one conda CLI command inside this process, capturing everything it prints.
+# Replies with "unsupported" instead of a return code when the worker itself cannot run the command,
+# so the client falls back to the conda CLI
+def run_command(args):
+    try:
+        from conda.cli.main import main_subshell
+    except ImportError as e:
+        # Older conda releases have no main_subshell
+        return {"unsupported": f"{type(e).__name__}: {e}"}
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            returncode = main_subshell(*args) or 0
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            # conda reports its own errors through the return code, so anything raised is a worker problem
+            return {"unsupported": f"{type(e).__name__}: {e}"}
+    return {"returncode": returncode, "output": output.getvalue()}
+
+
+# Handler for one request: a JSON line {"args": [...]} answered with {"returncode": ..., "output": ...}
+# or {"unsupported": reason}
+class CondaRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            reply = run_command([str(arg) for arg in request["args"]])
+        except (ValueError, KeyError, TypeError) as e:
+            reply = {"returncode": 2, "output": f"Bad request: {e}\n"}
+        self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+# Function to serve conda commands on a Unix socket until no request arrives for idle_timeout seconds
+def serve(socket_path, idle_timeout):
+    # Only one worker per socket; a second one started in a race just exits
+    lock_file = open(socket_path + ".lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return
+
+    # Pay the import and plugin discovery cost once, before accepting requests
+    import conda.cli.main  # noqa: F401
+    from conda.base.context import context
+    context.__init__()
+
+    # Holding the lock means any socket file left behind belongs to a dead worker
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(socket_path)
+    server = socketserver.UnixStreamServer(socket_path, CondaRequestHandler)
+    os.chmod(socket_path, 0o600)
+    server.timeout = idle_timeout
+    idle = []
+    server.handle_timeout = lambda: idle.append(True)
+    try:
+        while not idle:
+            server.handle_request()
+    finally:
+        server.server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1], float(sys.argv[2]))
@@ -1,17 +1,324 @@
 import os
+import re
+import sys
+import json
+import fcntl
+import atexit
+import stat
+import time
+import sqlite3
+import hashlib
+import threading
+import platform
 import subprocess
+import contextlib
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import click
 import shutil
+import io
+import tarfile
+import shlex
+import socket
+
+MINICONDA_URL = "https://repo.anaconda.com/miniconda/Miniconda3-latest-Linux-x86_64.sh"
+MICROMAMBA_URL = "https://micro.mamba.pm/api/micromamba/linux-64/latest"
+WORKER_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "conda_worker.py")
+# Commands the persistent worker serves; everything else always goes through the CLI
+WORKER_COMMANDS = {"list", "create", "install", "remove"}
+# Solver/installer front ends, fastest first, and the operations each one cannot run
+BACKEND_ORDER = ["micromamba", "mamba", "conda"]
+BACKEND_UNSUPPORTED = {"micromamba": {"clone", "config"}, "mamba": {"config", "shell"}}
+
+# Runtime options, filled in from the command line by main()
+CONFIG = {
+    "cache_dir": os.path.expanduser(os.environ.get("CONDA_SETUP_CACHE_DIR", "~/.cache/conda-setup")),
+    "installer_url": os.environ.get("CONDA_SETUP_INSTALLER_URL", MINICONDA_URL),
+    "installer_sha256": os.environ.get("CONDA_SETUP_INSTALLER_SHA256"),
+    "offline": False,
+    "keep_installers": 3,
+    # How long an installer without a published checksum or HTTP validators is reused before fetching it again
+    "installer_max_age_hours": 24,
+    "download_workers": 8,
+    "download_chunk_size": 8 * 1024 * 1024,
+    "jobs": None,
+    "lock_ttl_days": 7,
+    "refresh_locks": False,
+    "pkgs_dir": os.path.expanduser(os.environ.get("CONDA_SETUP_PKGS_DIR", "~/.cache/conda-setup/pkgs")),
+    "templates_path": os.environ.get("CONDA_SETUP_TEMPLATES"),
+    "use_worker": False,
+    "backend": "auto",
+    "bootstrap": "miniconda",
+    "micromamba_url": os.environ.get("CONDA_SETUP_MICROMAMBA_URL", MICROMAMBA_URL),
+    "worker_idle_timeout": 600,
+    "scan_workers": 16,
+}
+
+# Timing spans recorded by phase(), written out by --trace
+TRACE = {"start": time.perf_counter(), "spans": []}
 
 
 # Function to check if Conda is installed and return its installation directory
 def check_conda_installed():
+    # A micromamba bootstrap has no conda executable, only micromamba
+    return shutil.which("conda") or shutil.which("micromamba")
+
+# Function to time one provisioning phase (download, verify, extract, solve, link, ...) as a trace span
+@contextlib.contextmanager
+def phase(name, **details):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        TRACE["spans"].append({
+            "name": name,
+            "start": started - TRACE["start"],
+            "duration": time.perf_counter() - started,
+            "thread": threading.get_ident(),
+            "details": details,
+        })
+
+# Function to write the recorded spans as plain JSON or in Chrome trace format (chrome://tracing, Perfetto)
+def write_trace(trace_path, trace_format):
+    spans = sorted(TRACE["spans"], key=lambda span: span["start"])
+    if trace_format == "chrome":
+        data = {"traceEvents": [
+            {"name": span["name"], "ph": "X", "pid": os.getpid(), "tid": span["thread"],
+             "ts": round(span["start"] * 1e6), "dur": round(span["duration"] * 1e6), "args": span["details"]}
+            for span in spans
+        ]}
+    else:
+        data = {"command": sys.argv[1:], "spans": spans}
+    write_json_atomic(os.path.abspath(trace_path), data)
+
+# Function to compute the SHA-256 digest of a file
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Function to write a text file atomically so readers never see a partial file
+def write_file_atomic(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Unique per writer thread, since --spec writes the same lockfile or index from several threads at once;
+    # open() rather than mkstemp() keeps the umask-based mode other users of the shared cache need
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+# Function to write a JSON file atomically so readers never see a partial file
+def write_json_atomic(path, data):
+    write_file_atomic(path, json.dumps(data, indent=2, sort_keys=True))
+
+# Function to read a JSON file, returning a default when it is missing or unreadable
+def read_json(path, default):
     try:
-        result = subprocess.run(["which", "conda"], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        conda_path = result.stdout.strip()
-        return conda_path if conda_path else None
-    except subprocess.CalledProcessError:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+# Function to look up the SHA-256 published next to the installer in the repo index page
+def fetch_published_sha256(url):
+    index_url, filename = url.rsplit("/", 1)
+    try:
+        with urllib.request.urlopen(index_url + "/", timeout=30) as response:
+            page = response.read().decode("utf-8", "replace")
+    except (OSError, ValueError):
         return None
+    # Each installer is one table row: name, size, date, then its sha256
+    match = re.search(r'href="' + re.escape(filename) + r'"(?:(?!</tr>).)*?\b([0-9a-f]{64})\b', page, re.S)
+    return match.group(1) if match else None
+
+# Function to fetch a URL's ETag and Last-Modified headers, or None when the server cannot be reached
+def fetch_validators(url):
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method="HEAD"), timeout=30) as response:
+            return {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+    except (OSError, ValueError):
+        return None
+
+# Function to fetch one byte range of a URL into an open file, retrying on transient errors
+def download_range(url, fd, start, end, retries=3):
+    for attempt in range(retries):
+        try:
+            request = urllib.request.Request(url, headers={"Range": f"bytes={start}-{end}"})
+            with urllib.request.urlopen(request, timeout=60) as response:
+                if response.status != 206:
+                    raise OSError(f"server ignored range request (HTTP {response.status})")
+                offset = start
+                for block in iter(lambda: response.read(1024 * 1024), b""):
+                    os.pwrite(fd, block, offset)
+                    offset += len(block)
+            if offset != end + 1:
+                raise OSError(f"short read for bytes {start}-{end}")
+            return offset - start
+        except OSError:
+            if attempt == retries - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+# Function to download a URL in one stream when the server does not support ranges
+def download_stream(url, part_path):
+    digest = hashlib.sha256()
+    with urllib.request.urlopen(url, timeout=60) as response, open(part_path, "wb") as f:
+        for block in iter(lambda: response.read(1024 * 1024), b""):
+            f.write(block)
+            digest.update(block)
+    return digest.hexdigest()
+
+# Function to download a URL with concurrent Range requests, hashing as chunks land and resuming partial downloads
+def download_file(url, dest_path):
+    part_path = dest_path + ".part"
+    state_path = dest_path + ".state"
+    started = time.time()
+
+    try:
+        head = urllib.request.Request(url, method="HEAD")
+        with urllib.request.urlopen(head, timeout=30) as response:
+            size = int(response.headers.get("Content-Length") or 0)
+            ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    except OSError:
+        size, ranges = 0, False
+    if not size or not ranges:
+        click.echo(f"Downloading {url} (single stream)...")
+        sha = download_stream(url, part_path)
+        size = os.path.getsize(part_path)
+        fetched = size
+    else:
+        chunk_size = CONFIG["download_chunk_size"]
+        chunks = [(start, min(start + chunk_size, size) - 1) for start in range(0, size, chunk_size)]
+        state = read_json(state_path, {})
+        if state.get("url") != url or state.get("size") != size or state.get("chunk_size") != chunk_size or not os.path.exists(part_path):
+            state = {"url": url, "size": size, "chunk_size": chunk_size, "done": []}
+        done = set(state["done"])
+        if done:
+            click.echo(f"Resuming download of {url} ({len(done)}/{len(chunks)} chunks already on disk)...")
+        else:
+            click.echo(f"Downloading {url} in {len(chunks)} chunks...")
+
+        digest = hashlib.sha256()
+        next_to_hash = 0
+        fetched = 0
+        if not done:
+            open(part_path, "wb").close()
+        with open(part_path, "r+b") as f:
+            f.truncate(size)
+            fd = f.fileno()
+
+            # Hash the contiguous prefix of finished chunks so the digest is ready when the last one lands
+            def hash_ready_chunks():
+                nonlocal next_to_hash
+                while next_to_hash in done:
+                    start, end = chunks[next_to_hash]
+                    digest.update(os.pread(fd, end - start + 1, start))
+                    next_to_hash += 1
+
+            hash_ready_chunks()
+            with ThreadPoolExecutor(max_workers=CONFIG["download_workers"]) as pool:
+                futures = {pool.submit(download_range, url, fd, *chunks[i]): i for i in range(len(chunks)) if i not in done}
+                last_report = time.time()
+                try:
+                    for future in as_completed(futures):
+                        fetched += future.result()
+                        done.add(futures[future])
+                        state["done"] = sorted(done)
+                        write_json_atomic(state_path, state)
+                        hash_ready_chunks()
+                        if time.time() - last_report >= 1:
+                            last_report = time.time()
+                            rate = fetched / max(last_report - started, 1e-6) / 1e6
+                            click.echo(f"  {len(done)}/{len(chunks)} chunks, {rate:.1f} MB/s")
+                finally:
+                    # On a failed chunk, drop the queued ones and record every chunk that did land for the resume
+                    for future in futures:
+                        future.cancel()
+                    wait(futures)
+                    done.update(futures[future] for future in futures if not future.cancelled() and future.exception() is None)
+                    state["done"] = sorted(done)
+                    write_json_atomic(state_path, state)
+        sha = digest.hexdigest()
+        os.remove(state_path)
+
+    os.replace(part_path, dest_path)
+    elapsed = max(time.time() - started, 1e-6)
+    click.echo(f"Downloaded {size / 1e6:.1f} MB in {elapsed:.1f}s ({fetched / elapsed / 1e6:.1f} MB/s).")
+    return sha
+
+# Function to drop the least recently used installers beyond the configured limit
+def evict_installers(cache_dir, index):
+    keep = max(CONFIG["keep_installers"], 1)
+    by_last_use = sorted(index, key=lambda sha: index[sha]["last_used"], reverse=True)
+    for sha in by_last_use[keep:]:
+        try:
+            os.remove(os.path.join(cache_dir, f"{sha}.sh"))
+        except FileNotFoundError:
+            pass
+        del index[sha]
+
+# Function to return a verified installer path from the content-addressed cache, downloading it if needed
+def get_installer(url, expected=None, kind="miniconda"):
+    cache_dir = os.path.join(CONFIG["cache_dir"], "installers")
+    index_path = os.path.join(cache_dir, "index.json")
+    os.makedirs(cache_dir, exist_ok=True)
+    index = read_json(index_path, {})
+
+    if CONFIG["offline"]:
+        # Prefer the most recent installer fetched from this URL, then any other cached one of the same kind;
+        # entries from before kinds were recorded only match their own URL
+        candidates = [sha for sha in index if index[sha].get("kind") == kind or index[sha]["url"] == url]
+        candidates.sort(key=lambda sha: (index[sha]["url"] == url, index[sha]["last_used"]), reverse=True)
+        for sha in candidates:
+            path = os.path.join(cache_dir, f"{sha}.sh")
+            with phase("verify", installer=sha[:12]):
+                verified = os.path.exists(path) and sha256_file(path) == sha
+            if verified:
+                click.echo(f"Offline mode: using cached installer {sha[:12]}.")
+                break
+        else:
+            raise click.ClickException("Offline mode: no verified installer found in the cache.")
+    else:
+        expected = expected or fetch_published_sha256(url)
+        sha, validators = expected, None
+        previous = sorted((sha for sha in index if index[sha]["url"] == url), key=lambda sha: index[sha]["last_used"])
+        if not expected:
+            # Without a published checksum (the micromamba API has no index page), reuse the last installer
+            # from this URL only while the server still reports the same ETag/Last-Modified, or, when it
+            # reports neither, for a limited time, so .../latest URLs still pick up new releases
+            validators = fetch_validators(url)
+            if previous:
+                entry = index[previous[-1]]
+                if validators and any(validators.values()):
+                    unchanged = validators == entry.get("validators")
+                else:
+                    unchanged = time.time() - entry.get("fetched", 0) < CONFIG["installer_max_age_hours"] * 3600
+                sha = previous[-1] if unchanged else None
+        path = os.path.join(cache_dir, f"{sha}.sh") if sha else None
+        with phase("verify", installer=(sha or "")[:12]):
+            cached = bool(path) and os.path.exists(path) and sha256_file(path) == sha
+        if cached:
+            click.echo(f"Using cached installer {sha[:12]}.")
+        else:
+            # Name the download after its URL so an interrupted fetch is resumed on the next run
+            tmp_path = os.path.join(cache_dir, "download-" + hashlib.sha256(url.encode()).hexdigest()[:16])
+            with phase("download", url=url):
+                sha = download_file(url, tmp_path)
+            if expected and sha != expected:
+                os.remove(tmp_path)
+                raise click.ClickException(f"Checksum mismatch for {url}: expected {expected}, got {sha}.")
+            if not expected:
+                click.echo("Warning: no published checksum found, caching installer by its computed hash.")
+            path = os.path.join(cache_dir, f"{sha}.sh")
+            os.replace(tmp_path, path)
+            index[sha] = {"url": url, "fetched": time.time(), "validators": validators}
+
+    index[sha] = dict(index.get(sha, {}), url=index.get(sha, {}).get("url", url), kind=kind, last_used=time.time())
+    evict_installers(cache_dir, index)
+    write_json_atomic(index_path, index)
+    return path
 
 # Function to install Miniconda
 def install_conda():
@@ -23,19 +330,41 @@ def install_conda():
         click.echo(f"Miniconda is already installed at: {existing_conda_path}")
         return existing_conda_path
 
-    # Download and install Miniconda
-    subprocess.run(["wget", "https://repo.anaconda.com/miniconda/Miniconda3-latest-Linux-x86_64.sh", "-O", "miniconda.sh"], check=True)
-    subprocess.run(["bash", "miniconda.sh", "-b", "-p", os.path.expanduser("~/miniconda")], check=True)
-    os.remove("miniconda.sh")
+    if CONFIG["bootstrap"] == "micromamba":
+        install_micromamba(os.path.expanduser("~/miniconda"))
+    else:
+        # Fetch the installer through the local cache and install Miniconda
+        installer_path = get_installer(CONFIG["installer_url"], CONFIG["installer_sha256"])
+        with phase("extract", installer=installer_path):
+            subprocess.run(["bash", installer_path, "-b", "-p", os.path.expanduser("~/miniconda")], check=True)
 
     # Add Conda to PATH temporarily
     os.environ["PATH"] = os.path.expanduser("~/miniconda/bin") + ":" + os.environ["PATH"]
 
-    # Initialize Conda
-    subprocess.run(["conda", "init"], check=True)
+    # Initialize Conda with static activation scripts instead of the per-shell 'conda shell.bash hook'
+    with phase("conda_init"):
+        install_activation_hook(os.path.expanduser("~/miniconda"))
+
+        # Point the new install at the shared package cache so it survives reinstalls
+        if shutil.which("conda"):
+            subprocess.run(["conda", "config", "--system", "--add", "pkgs_dirs", CONFIG["pkgs_dir"]], check=True)
     click.echo("Installation completed successfully.")
     return os.path.expanduser("~/miniconda")
 
+# Function to bootstrap a root prefix with the static micromamba binary instead of the Miniconda installer
+def install_micromamba(root):
+    archive_path = get_installer(CONFIG["micromamba_url"], kind="micromamba")
+    with phase("extract", installer=archive_path):
+        os.makedirs(os.path.join(root, "bin"), exist_ok=True)
+        binary_path = os.path.join(root, "bin", "micromamba")
+        with tarfile.open(archive_path, "r:bz2") as archive, open(binary_path, "wb") as f:
+            shutil.copyfileobj(archive.extractfile("bin/micromamba"), f)
+        os.chmod(binary_path, 0o755)
+    # A base environment with Python gives the prefix the same layout as a Miniconda install
+    with phase("solve_and_link", env="base"):
+        os.makedirs(os.path.join(root, "conda-meta"), exist_ok=True)
+        subprocess.run([binary_path, "install", "--yes", "--root-prefix", root, "--name", "base", "-c", "conda-forge", "python"], check=True)
+
 # Function to prompt the user to install Conda or exit
 def prompt_install_or_exit():
     click.echo("Conda is not installed.")
@@ -46,34 +375,260 @@ def prompt_install_or_exit():
         click.echo("Exiting...")
         raise SystemExit(1)
 
-# Function to install Conda
-def install_conda():
-    click.echo("Installing Miniconda as an interactive shell...")
-    subprocess.run(["wget", "https://repo.anaconda.com/miniconda/Miniconda3-latest-Linux-x86_64.sh", "-O", "miniconda.sh"], check=True)
-    subprocess.run(["bash", "miniconda.sh", "-b", "-p", os.path.expanduser("~/miniconda")], check=True)
-    os.remove("miniconda.sh")
+# Function to find the root prefix of the Conda installation without running conda
+def find_conda_root():
+    for conda_path in (os.environ.get("CONDA_EXE"), check_conda_installed(), os.path.expanduser("~/miniconda/bin/conda")):
+        if not conda_path:
+            continue
+        # conda lives in <root>/bin or <root>/condabin
+        root = os.path.dirname(os.path.dirname(os.path.realpath(conda_path)))
+        if os.path.isdir(os.path.join(root, "conda-meta")):
+            return root
+    return None
 
-    # Add Conda to PATH temporarily
-    os.environ["PATH"] = os.path.expanduser("~/miniconda/bin") + ":" + os.environ["PATH"]
+# Function to collect every environment prefix from the envs directories and ~/.conda/environments.txt
+def discover_env_prefixes(root):
+    candidates = [root] if root else []
+    envs_dirs = [os.path.join(root, "envs")] if root else []
+    envs_dirs.append(os.path.expanduser("~/.conda/envs"))
+    for envs_dir in envs_dirs:
+        try:
+            candidates.extend(entry.path for entry in os.scandir(envs_dir) if entry.is_dir())
+        except FileNotFoundError:
+            pass
+    try:
+        with open(os.path.expanduser("~/.conda/environments.txt"), "r") as f:
+            candidates.extend(line.strip() for line in f if line.strip())
+    except FileNotFoundError:
+        pass
 
-    # Initialize Conda
-    subprocess.run(["conda", "init"], check=True)
-    click.echo("Installation completed successfully.")
+    prefixes, seen = [], set()
+    for prefix in candidates:
+        real_prefix = os.path.realpath(prefix)
+        if real_prefix not in seen and os.path.isdir(os.path.join(real_prefix, "conda-meta")):
+            seen.add(real_prefix)
+            prefixes.append(real_prefix)
+    return prefixes
+
+# Function to return a cheap fingerprint that changes whenever packages are added or removed
+def env_fingerprint(prefix):
+    meta_dir = os.path.join(prefix, "conda-meta")
+    stamps = [os.stat(meta_dir).st_mtime_ns]
+    try:
+        stamps.append(os.stat(os.path.join(meta_dir, "history")).st_mtime_ns)
+    except FileNotFoundError:
+        pass
+    return max(stamps)
+
+# Function to total the disk usage of a directory tree, counting hardlinked files once
+def dir_size(path, skip=()):
+    total, seen_inodes, stack = 0, set(), [path]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path not in skip:
+                    stack.append(entry.path)
+                continue
+            info = entry.stat(follow_symlinks=False)
+            if info.st_nlink > 1:
+                if (info.st_dev, info.st_ino) in seen_inodes:
+                    continue
+                seen_inodes.add((info.st_dev, info.st_ino))
+            total += info.st_size
+    return total
+
+# Function to read an environment's name, Python version, package count and size from disk
+def describe_env(prefix, root, fingerprint):
+    records = [name for name in os.listdir(os.path.join(prefix, "conda-meta")) if name.endswith(".json")]
+    python = next((match.group(1) for match in map(re.compile(r"python-(\d[^-]*)-").match, records) if match), None)
+    history_path = os.path.join(prefix, "conda-meta", "history")
+    return {
+        "name": "base" if prefix == root else os.path.basename(prefix),
+        "prefix": prefix,
+        "python": python,
+        "packages": len(records),
+        # The base prefix also holds every named environment and the package cache
+        "size": dir_size(prefix, skip={os.path.join(prefix, "envs"), os.path.join(prefix, "pkgs")} if prefix == root else ()),
+        "updated": os.path.getmtime(history_path) if os.path.exists(history_path) else None,
+        "fingerprint": fingerprint,
+    }
+
+# Function to return all environments from the on-disk index, refreshing only entries whose conda-meta changed
+def load_env_index():
+    index_path = os.path.join(CONFIG["cache_dir"], "env-index.json")
+    cached = read_json(index_path, {})
+    root = find_conda_root()
+
+    index, stale = {}, []
+    for prefix in discover_env_prefixes(root):
+        fingerprint = env_fingerprint(prefix)
+        entry = cached.get(prefix)
+        if entry and entry["fingerprint"] == fingerprint:
+            index[prefix] = entry
+        else:
+            stale.append((prefix, fingerprint))
+    if stale:
+        with ThreadPoolExecutor() as pool:
+            for entry in pool.map(lambda item: describe_env(item[0], root, item[1]), stale):
+                index[entry["prefix"]] = entry
+    if stale or index.keys() != cached.keys():
+        write_json_atomic(index_path, index)
+    return sorted(index.values(), key=lambda entry: (entry["name"] != "base", entry["name"]))
+
+ACTIVATION_BEGIN = "# >>> conda-setup activation >>>"
+ACTIVATION_END = "# <<< conda-setup activation <<<"
+
+# Function to return the static activation script path for an environment name
+def activation_script_path(name, kind="activate"):
+    return os.path.join(CONFIG["cache_dir"], kind, f"{name}.sh")
+
+# Function to compute an environment's activation once and cache it as a sourceable script
+def write_activation_script(env):
+    script_path = activation_script_path(env["name"])
+    # Run the activation against placeholder PATH/PS1 values so the output is a delta that
+    # applies on top of whatever the sourcing shell has, rather than a snapshot of ours
+    clean_env = {key: value for key, value in os.environ.items() if not key.startswith("CONDA_") or key == "CONDA_PKGS_DIRS"}
+    clean_env.update(PATH="__CONDA_SETUP_PATH__", PS1="__CONDA_SETUP_PS1__")
+    backend, executable = choose_backend(["shell"])
+    if backend == "micromamba":
+        clean_env["MAMBA_ROOT_PREFIX"] = find_conda_root() or os.path.expanduser("~/miniconda")
+        command = [executable, "shell", "activate", "--shell", "posix", "--prefix", env["prefix"]]
+        deactivate_command = [executable, "shell", "deactivate", "--shell", "posix"]
+    else:
+        command = [executable, "shell.posix", "activate", env["prefix"]]
+        deactivate_command = [executable, "shell.posix", "deactivate"]
+    commands = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=clean_env).stdout
+    commands = commands.replace("__CONDA_SETUP_PATH__", "'\"$PATH\"'").replace("__CONDA_SETUP_PS1__", "'\"$PS1\"'")
+
+    # The matching deactivation runs deactivate.d scripts and unsets env config vars; the hook restores
+    # PATH and PS1 itself, so those lines are dropped
+    active_env = dict(clean_env, CONDA_PREFIX=env["prefix"], CONDA_SHLVL="1", CONDA_DEFAULT_ENV=env["name"],
+                      PATH=os.path.join(env["prefix"], "bin") + ":__CONDA_SETUP_PATH__")
+    result = subprocess.run(deactivate_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=active_env)
+    # Without it the hook still restores PATH and PS1 and unsets the CONDA_* variables
+    deactivate = result.stdout if result.returncode == 0 else ""
+    deactivate = "".join(line for line in deactivate.splitlines(keepends=True) if not re.match(r"\s*(export\s+)?(PATH|PS1)=", line))
+    write_file_atomic(activation_script_path(env["name"], "deactivate"),
+                      f"# Static deactivation for {env['prefix']}, generated by install.py\n" + deactivate)
+
+    history_path = os.path.join(env["prefix"], "conda-meta", "history")
+    rerun = f"{shlex.quote(sys.executable)} {shlex.quote(os.path.abspath(__file__))} --refresh-activation"
+    write_file_atomic(script_path, "".join([
+        f"# Static activation for {env['prefix']}, generated by install.py\n",
+        f"# fingerprint: {env['fingerprint']}\n",
+        # Regenerate (one Python start) only when a conda transaction has touched the environment
+        # The guard variable stops a history file dated in the future (clock skew) from re-sourcing forever
+        f'if [ -z "${{_CONDA_SETUP_REFRESHING:-}}" ] && [ {shlex.quote(history_path)} -nt {shlex.quote(script_path)} ] '
+        f"&& {rerun} >/dev/null 2>&1; then\n",
+        f"    _CONDA_SETUP_REFRESHING=1\n    . {shlex.quote(script_path)}\n    unset _CONDA_SETUP_REFRESHING\n",
+        "    return 0 2>/dev/null\nfi\n",
+        commands,
+    ]))
+    return script_path
+
+# Function to return an environment's cached activation script, regenerating it if the environment changed
+def activation_script(env):
+    script_path = activation_script_path(env["name"])
+    try:
+        with open(script_path, "r") as f:
+            f.readline()
+            up_to_date = f.readline().strip() == f"# fingerprint: {env['fingerprint']}"
+        if up_to_date:
+            # Touch it so a history write that changed no packages stops triggering regeneration
+            os.utime(script_path)
+            return script_path
+    except FileNotFoundError:
+        pass
+    return write_activation_script(env)
+
+# Function to bring every environment's activation script up to date
+def refresh_activation_scripts():
+    envs = load_env_index()
+    for env in envs:
+        activation_script(env)
+    return envs
+
+# Function to replace the conda init hook in the rc files with one that only sources cached scripts
+def install_activation_hook(root):
+    refresh_activation_scripts()
+    scripts_dir = os.path.dirname(activation_script_path("base"))
+    deactivate_dir = os.path.dirname(activation_script_path("base", "deactivate"))
+    hook = f"""{ACTIVATION_BEGIN}
+# Sources static scripts written by install.py, so no conda Python runs at shell startup
+export PATH={shlex.quote(os.path.join(root, "condabin"))}:"$PATH"
+# The saved state is exported so nested shells keep the parent's environment instead of stacking base on it
+_conda_setup_deactivate() {{
+    if [ -n "${{_CONDA_SETUP_ENV+x}}" ]; then
+        _conda_setup_script={shlex.quote(deactivate_dir)}/"$_CONDA_SETUP_ENV.sh"
+        if [ -f "$_conda_setup_script" ]; then
+            . "$_conda_setup_script"
+        fi
+        PATH="$_CONDA_SETUP_PATH"; PS1="$_CONDA_SETUP_PS1"
+        unset _CONDA_SETUP_PATH _CONDA_SETUP_PS1 _CONDA_SETUP_ENV CONDA_PREFIX CONDA_DEFAULT_ENV CONDA_PROMPT_MODIFIER \\
+            CONDA_SHLVL CONDA_EXE _CONDA_EXE CONDA_PYTHON_EXE _CONDA_ROOT _CE_M _CE_CONDA
+    fi
+}}
+_conda_setup_activate() {{
+    _conda_setup_script={shlex.quote(scripts_dir)}/"${{1##*/}}.sh"
+    if [ ! -f "$_conda_setup_script" ]; then
+        echo "No activation script for '$1'; run install.py to create it." >&2
+        return 1
+    fi
+    _conda_setup_deactivate
+    export _CONDA_SETUP_PATH="$PATH" _CONDA_SETUP_PS1="$PS1" _CONDA_SETUP_ENV="${{1##*/}}"
+    . {shlex.quote(scripts_dir)}/"${{1##*/}}.sh"
+}}
+conda() {{
+    case "$1" in
+        activate) _conda_setup_activate "${{2:-base}}" ;;
+        deactivate) _conda_setup_deactivate ;;
+        *) command conda "$@" ;;
+    esac
+}}
+if [ -z "${{_CONDA_SETUP_ENV+x}}" ]; then
+    _conda_setup_activate base
+fi
+{ACTIVATION_END}
+"""
+    with phase("rc_edit"):
+        # Old blocks go from both files, but like conda init the hook only goes into .bashrc,
+        # which .bash_profile normally sources
+        for file_path in ["~/.bashrc", "~/.bash_profile"]:
+            full_path = os.path.realpath(os.path.expanduser(file_path))
+            if file_path != "~/.bashrc" and not os.path.exists(full_path):
+                continue
+            remove_rc_block(file_path, "# >>> conda initialize >>>", "# <<< conda initialize <<<")
+            remove_rc_block(file_path, ACTIVATION_BEGIN, ACTIVATION_END)
+        with open(os.path.realpath(os.path.expanduser("~/.bashrc")), "a") as f:
+            f.write(hook)
+
+# Function to check whether the rc file still starts conda through its init hook instead of the static scripts
+def activation_hook_outdated():
+    try:
+        with open(os.path.expanduser("~/.bashrc"), "r") as f:
+            content = f.read()
+    except FileNotFoundError:
+        return False
+    return "# >>> conda initialize >>>" in content and ACTIVATION_BEGIN not in content
 
 # Function to list all Conda environments and prompt the user to select one
 def list_and_select_env():
-    envs_info = subprocess.run(["conda", "info", "--envs"], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    envs_list = envs_info.stdout.strip().split("\n")
+    with phase("discover"):
+        envs = load_env_index()
     click.echo("Available Conda environments:")
-    for i, env_path in enumerate(envs_list[1:]):
-        env_name = os.path.basename(env_path.strip().split()[0])
-        click.echo(f"{i+1}. {env_name}")
+    for i, env in enumerate(envs):
+        click.echo(f"{i+1}. {env['name']} (python {env['python'] or '-'}, {env['packages']} packages, {env['size'] / 1e6:.0f} MB)")
     choice = click.prompt("Enter the number of the environment you want to use or '0' to create a new environment", type=int)
     if choice == 0:
         create_new_env()
-    elif choice > 0 and choice <= len(envs_list) - 1:
-        selected_env = os.path.basename(envs_list[choice].strip().split()[0])
-        subprocess.run(["conda", "activate", selected_env], check=True)
+    elif choice > 0 and choice <= len(envs):
+        selected_env = envs[choice - 1]
+        script_path = activation_script(selected_env)
+        click.echo(f"Activate it with: conda activate {selected_env['name']}  (or: source {script_path})")
     else:
         click.echo("Invalid choice.")
 
@@ -81,15 +636,848 @@ def list_and_select_env():
 def create_new_env():
     click.echo("Creating a new Conda environment...")
     new_env_name = click.prompt("Please enter the name for the new Conda environment")
-    subprocess.run(["conda", "create", "--name", new_env_name], check=True)
+    templates = load_templates()
+    template = None
+    if templates:
+        click.echo(f"Registered templates: {', '.join(sorted(templates))}")
+        template = click.prompt("Template to clone from (blank for none)", default="", show_default=False) or None
+    packages = click.prompt("Packages to install (space separated, blank for none)", default="", show_default=False).split()
+    create_env(new_env_name, packages, template=template)
     click.echo(f"New environment '{new_env_name}' created successfully.")
-    subprocess.run(["conda", "activate", new_env_name], check=True)
+    new_env = next(env for env in load_env_index() if env["name"] == new_env_name)
+    script_path = activation_script(new_env)
+    click.echo(f"Activate it with: conda activate {new_env_name}  (or: source {script_path})")
+
+# Function to start the persistent conda worker under the base environment's Python and wait for its socket
+def start_worker(socket_path):
+    root = find_conda_root()
+    python = os.path.join(root or "", "bin", "python")
+    if not root or not os.access(python, os.X_OK) or not os.path.exists(os.path.join(root, "bin", "conda")):
+        return False
+    process = subprocess.Popen([python, WORKER_PY, socket_path, str(CONFIG["worker_idle_timeout"])], start_new_session=True,
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if os.path.exists(socket_path):
+            return True
+        if process.poll() is not None:
+            return False
+        time.sleep(0.05)
+    return False
+
+# Function to send a conda command to the persistent worker, returning None when no worker can serve it
+def run_in_worker(args):
+    socket_path = os.path.join(CONFIG["cache_dir"], "worker.sock")
+    os.makedirs(CONFIG["cache_dir"], exist_ok=True)
+    for attempt in range(2):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                # A wedged worker must not hang us; the command itself may run for as long as a solve takes
+                sock.settimeout(5)
+                sock.connect(socket_path)
+                sock.settimeout(None)
+                sock.sendall(json.dumps({"args": args}).encode() + b"\n")
+                with sock.makefile("rb") as reply_file:
+                    reply = json.loads(reply_file.readline())
+            # The worker could not run this command in-process (e.g. an older conda), so use the CLI
+            return None if "unsupported" in reply else reply
+        except (OSError, ValueError):
+            # No worker yet (or it just timed out): start one once, then give up and use the CLI
+            if attempt or not start_worker(socket_path):
+                return None
+
+# Function to find the conda, mamba and micromamba executables that are available
+def detect_backends():
+    root = find_conda_root()
+    available = {}
+    for name in BACKEND_ORDER:
+        candidates = [shutil.which(name)]
+        if root:
+            candidates += [os.path.join(root, "bin", name), os.path.join(root, "condabin", name)]
+        path = next((path for path in candidates if path and os.access(path, os.X_OK)), None)
+        if path:
+            available[name] = path
+    return available
+
+# Function to pick the backend for a command: the --backend choice if it can run it, else the fastest available one
+def choose_backend(args):
+    operation = "clone" if "--clone" in args else args[0]
+    available = detect_backends()
+    preferred = [CONFIG["backend"]] if CONFIG["backend"] != "auto" else []
+    for name in preferred + BACKEND_ORDER:
+        if name in available and operation not in BACKEND_UNSUPPORTED.get(name, ()):
+            return name, available[name]
+    raise click.ClickException(f"No conda, mamba or micromamba executable can run '{operation}'.")
+
+# Function to translate conda arguments into micromamba's spelling where they differ
+def micromamba_args(args):
+    name = args[args.index("--name") + 1] if "--name" in args else "base"
+    if args[0] == "list" and "--explicit" in args:
+        return ["env", "export", "--name", name, "--explicit", "--md5"]
+    if args[0] == "remove" and "--all" in args:
+        return ["env", "remove", "--name", name, "--yes"]
+    return args
+
+# Function to run a conda command on the selected backend, optionally capturing its combined output
+def run_conda(args, capture=False):
+    backend, executable = choose_backend(args)
+    env = None
+    if backend == "micromamba":
+        args = micromamba_args(args)
+        # Resolve environment names against the same envs directory conda uses
+        env = dict(os.environ, MAMBA_ROOT_PREFIX=find_conda_root() or os.path.expanduser("~/miniconda"))
+    if backend == "conda" and CONFIG["use_worker"] and args[0] in WORKER_COMMANDS:
+        reply = run_in_worker(args)
+        if reply is not None:
+            if reply["returncode"]:
+                raise subprocess.CalledProcessError(reply["returncode"], ["conda", *args], output=reply["output"])
+            if not capture:
+                click.echo(reply["output"], nl=False)
+            return subprocess.CompletedProcess(["conda", *args], 0, stdout=reply["output"] if capture else None)
+    if capture:
+        return subprocess.run([executable, *args], check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env)
+    return subprocess.run([executable, *args], check=True, env=env)
+
+# Function to return the conda platform subdir of this machine, e.g. linux-64
+def conda_subdir():
+    machine = platform.machine().lower()
+    system = {"darwin": "osx", "win32": "win"}.get(sys.platform, "linux")
+    arch = {"x86_64": "64", "amd64": "64", "arm64": "arm64" if system == "osx" else "aarch64"}.get(machine, machine)
+    return f"{system}-{arch}"
+
+# Function to return the lockfile cache path for a normalized package spec, channels and platform
+def lockfile_path(packages, channels):
+    normalized = {
+        "packages": sorted(re.sub(r"\s+", "", package).lower() for package in packages),
+        # Channel order sets priority, so it is part of the key as given
+        "channels": list(channels),
+        "subdir": conda_subdir(),
+    }
+    key = hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+    return os.path.join(CONFIG["cache_dir"], "locks", f"{key}.txt")
+
+# Function to check whether a cached lockfile exists and is younger than the configured TTL
+def lockfile_is_fresh(lock_path):
+    if CONFIG["refresh_locks"] or not os.path.exists(lock_path):
+        return False
+    return time.time() - os.path.getmtime(lock_path) < CONFIG["lock_ttl_days"] * 86400
+
+# Function to return the template registry path, shared by every user of the package cache unless overridden
+def templates_path():
+    return os.path.abspath(os.path.expanduser(CONFIG["templates_path"] or os.path.join(CONFIG["pkgs_dir"], ".templates.json")))
+
+# Function to load the registry of golden template environments
+def load_templates():
+    # Templates registered before the registry moved next to the shared cache still count, for their owner
+    templates = read_json(os.path.join(CONFIG["cache_dir"], "templates.json"), {})
+    templates.update(read_json(templates_path(), {}))
+    return templates
+
+# Function to register an existing, fully populated environment as a golden template
+def register_template(env_name):
+    envs = {env["name"]: env for env in load_env_index()}
+    if env_name not in envs:
+        raise click.ClickException(f"No environment named '{env_name}'.")
+    templates = read_json(templates_path(), {})
+    templates[env_name] = {"prefix": envs[env_name]["prefix"], "packages": envs[env_name]["packages"], "registered": time.time()}
+    write_json_atomic(templates_path(), templates)
+    click.echo(f"Registered '{env_name}' ({envs[env_name]['prefix']}) as a template in {templates_path()}.")
+
+# Function to clone a golden template, then install any extra packages on top of it
+def create_env_from_template(name, template, packages=(), channels=(), capture=False):
+    templates = load_templates()
+    if template not in templates:
+        raise click.ClickException(f"Unknown template '{template}'. Register it first with --register-template.")
+    # --clone links files from the package cache (hardlinks where possible) and rewrites
+    # prefix-dependent files; --offline guarantees nothing is downloaded again
+    with phase("link", env=name, source="template"):
+        result = run_conda(["create", "--name", name, "--clone", templates[template]["prefix"], "--offline", "--yes"], capture=capture)
+    output = result.stdout or ""
+    if packages:
+        channel_args = [arg for channel in channels for arg in ("-c", channel)]
+        with phase("solve_and_link", env=name, source="template_delta"):
+            result = run_conda(["install", "--name", name, "--yes", *channel_args, *packages], capture=capture)
+        output += result.stdout or ""
+    return output
+
+# Function to create an environment, installing from a cached explicit lockfile when possible to skip the solve
+def create_env(name, packages=(), channels=(), template=None, capture=False):
+    if template:
+        return create_env_from_template(name, template, packages, channels, capture=capture)
+    lock_path = lockfile_path(packages, channels)
+    output = ""
+    if lockfile_is_fresh(lock_path):
+        try:
+            with phase("link", env=name, source="lockfile"):
+                result = run_conda(["create", "--name", name, "--yes", "--file", lock_path], capture=capture)
+            return f"Created '{name}' from cached lockfile {lock_path}\n" + (result.stdout or "")
+        except subprocess.CalledProcessError as e:
+            # A lockfile can go bad if a channel drops a build, so fall back to a fresh solve
+            output = f"Cached lockfile {lock_path} failed, solving from scratch\n" + (e.stdout or "")
+            os.remove(lock_path)
+            # A failed fetch leaves no prefix behind, and conda refuses to remove an environment that does not exist
+            with contextlib.suppress(subprocess.CalledProcessError):
+                run_conda(["remove", "--name", name, "--all", "--yes"], capture=True)
+
+    channel_args = [arg for channel in channels for arg in ("-c", channel)]
+    # conda solves and links in one command, so both land in a single span
+    with phase("solve_and_link", env=name):
+        result = run_conda(["create", "--name", name, "--yes", *channel_args, *packages], capture=capture)
+    with phase("lock", env=name):
+        explicit = run_conda(["list", "--name", name, "--explicit", "--md5"], capture=True).stdout
+    header = f"# spec: {' '.join(packages)}\n# channels: {' '.join(channels)}\n# platform: {conda_subdir()}\n"
+    write_file_atomic(lock_path, header + explicit)
+    return output + (result.stdout or "")
+
+# Function to load a declarative environment spec from a YAML or JSON file
+def load_spec(spec_path):
+    with open(spec_path, "r") as f:
+        if spec_path.endswith(".json"):
+            spec = json.load(f)
+        else:
+            import yaml
+            spec = yaml.safe_load(f)
+    envs = (spec or {}).get("environments") or []
+    # Accept either a list of entries with a name or a mapping of name to entry
+    if isinstance(envs, dict):
+        envs = [dict(entry or {}, name=name) for name, entry in envs.items()]
+    names = [env.get("name") for env in envs]
+    if not all(names) or len(set(names)) != len(names):
+        raise click.ClickException(f"{spec_path}: every environment needs a unique name.")
+    # YAML reads python: 3.10 as the float 3.1, so versions must be quoted
+    for env in envs:
+        if env.get("python") is not None and not isinstance(env["python"], str):
+            raise click.ClickException(f"{spec_path}: python version of '{env['name']}' must be a quoted string, e.g. python: \"{env['python']}\".")
+    return spec, envs
+
+# Function to create or update one environment from its spec entry without prompting
+def provision_env(env, existing_envs, log_dir):
+    name = env["name"]
+    packages = list(env.get("packages") or [])
+    if env.get("python"):
+        packages.insert(0, f"python={env['python']}")
+    channels = list(env.get("channels") or [])
+    channel_args = [arg for channel in channels for arg in ("-c", channel)]
+    action = "updated" if name in existing_envs else "created"
+
+    log_path = os.path.join(log_dir, f"{name}.log")
+    started = time.time()
+    try:
+        if action == "created":
+            output = create_env(name, packages, channels, template=env.get("template"), capture=True)
+        elif not packages:
+            # conda install refuses an empty spec list, and there is nothing to add to the environment anyway
+            output, action = "", "unchanged"
+        else:
+            with phase("solve_and_link", env=name):
+                output = run_conda(["install", "--name", name, "--yes", *channel_args, *packages], capture=True).stdout
+        status, error = "ok", None
+    except subprocess.CalledProcessError as e:
+        output, status = e.stdout or "", "failed"
+        error = (output.strip().splitlines() or [f"conda exited with status {e.returncode}"])[-1]
+    except (click.ClickException, OSError) as e:
+        # An unknown template, a missing backend or an unwritable path fails only this entry
+        output, status = f"{e}\n", "failed"
+        error = e.format_message() if isinstance(e, click.ClickException) else str(e)
+    with open(log_path, "w") as f:
+        f.write(output)
+    return {"name": name, "action": action, "status": status, "error": error, "log": log_path, "duration": round(time.time() - started, 3)}
+
+# Function to provision every environment in a spec file over a bounded worker pool
+def provision_from_spec(spec_path, summary_path):
+    spec, envs = load_spec(spec_path)
+    # An explicit --jobs wins over the spec file's jobs
+    jobs = CONFIG["jobs"] or spec.get("jobs") or 4
+    # The worker runs one conda command at a time, so parallel runs use separate CLI processes instead
+    CONFIG["use_worker"] = CONFIG["use_worker"] and jobs == 1
+    log_dir = os.path.join(CONFIG["cache_dir"], "logs")
+    os.makedirs(log_dir, exist_ok=True)
+
+    existing_envs = {env["name"] for env in load_env_index()}
+
+    click.echo(f"Provisioning {len(envs)} environments with {jobs} workers...")
+    started = time.time()
+    results = []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(provision_env, env, existing_envs, log_dir) for env in envs]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            click.echo(f"  {result['name']}: {result['action'] if result['status'] == 'ok' else 'FAILED'} in {result['duration']:.1f}s")
+
+    results.sort(key=lambda result: result["name"])
+    failed = [result["name"] for result in results if result["status"] != "ok"]
+    summary = {"spec": os.path.abspath(spec_path), "duration": round(time.time() - started, 3), "failed": len(failed), "environments": results}
+    write_json_atomic(os.path.abspath(summary_path), summary)
+    record_package_refs()
+    refresh_activation_scripts()
+    click.echo(f"Wrote summary to {summary_path}.")
+    if failed:
+        raise click.ClickException(f"{len(failed)} environment(s) failed: {', '.join(failed)}. See the logs in {log_dir}.")
+
+# Function to turn a size such as 512M or 20G into bytes
+def parse_size(size):
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", size.upper())
+    if not match:
+        raise click.BadParameter(f"invalid size '{size}'")
+    return int(float(match.group(1)) * 1024 ** " KMGT".index(match.group(2) or " "))
+
+# Function to create the shared package cache, group-writable so several users can share it
+def ensure_pkgs_dir():
+    pkgs_dir = CONFIG["pkgs_dir"]
+    if not os.path.isdir(pkgs_dir):
+        os.makedirs(pkgs_dir)
+        os.chmod(pkgs_dir, 0o2775)
+    # conda creates urls.txt, lock files and extracted packages under the caller's umask, usually 022,
+    # so keep them group-writable in a setgid (shared) cache; conda and the worker inherit the umask
+    if os.stat(pkgs_dir).st_mode & stat.S_ISGID:
+        umask = os.umask(0)
+        os.umask(umask & ~0o020)
+    return pkgs_dir
+
+# Function to record which of this user's environments reference each cached package
+def record_package_refs():
+    refs = {}
+    for env in load_env_index():
+        meta_dir = os.path.join(env["prefix"], "conda-meta")
+        for record in os.listdir(meta_dir):
+            # conda-meta/<name>-<version>-<build>.json matches the package's cache entry name
+            if record.endswith(".json"):
+                refs.setdefault(record[:-5], []).append(env["prefix"])
+    # One file per user and home directory so users sharing the cache never overwrite each other
+    owner = hashlib.sha256(os.path.expanduser("~").encode()).hexdigest()[:12]
+    refs_path = os.path.join(ensure_pkgs_dir(), ".refs", f"{os.getuid()}-{owner}.json")
+    write_json_atomic(refs_path, {"home": os.path.expanduser("~"), "updated": time.time(), "packages": refs})
+
+# Function to return the cached packages still installed in any known environment of any user,
+# along with when each package was last seen referenced
+def package_refs(pkgs_dir):
+    live, last_referenced = set(), {}
+    # Packages cached after a user last recorded their references may be in use by that user,
+    # so every package newer than the oldest refs file counts as live
+    unknown_since = time.time()
+    refs_dir = os.path.join(pkgs_dir, ".refs")
+    for refs_file in os.listdir(refs_dir) if os.path.isdir(refs_dir) else []:
+        refs = read_json(os.path.join(refs_dir, refs_file), None)
+        if not isinstance(refs, dict) or "updated" not in refs:
+            # An unreadable refs file says nothing about what its user has installed
+            unknown_since = 0
+            continue
+        unknown_since = min(unknown_since, refs["updated"])
+        for package, prefixes in refs.get("packages", {}).items():
+            last_referenced[package] = max(last_referenced.get(package, 0), refs["updated"])
+            # A reference stays live while the package record is still present in that prefix
+            if any(package_record_exists(prefix, package) for prefix in prefixes):
+                live.add(package)
+    return live, last_referenced, unknown_since
+
+# Function to check whether a prefix still has a package's record, assuming it does when the prefix is unreadable
+def package_record_exists(prefix, package):
+    try:
+        os.stat(os.path.join(prefix, "conda-meta", f"{package}.json"))
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+    except OSError:
+        # Another user's 0700 home hides their environments; never treat that as proof they are gone
+        return True
+    return True
+
+# Function to replace identical files in the package cache with hardlinks to a single copy
+def dedupe_package_cache(pkgs_dir):
+    candidates = {}
+    for dirpath, dirnames, filenames in os.walk(pkgs_dir):
+        dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            info = os.lstat(path)
+            if info.st_size and stat.S_ISREG(info.st_mode):
+                # Only files on the same device with the same size and mode can share an inode
+                candidates.setdefault((info.st_dev, info.st_size, info.st_mode), []).append((path, info.st_ino))
+    groups = [group for group in candidates.values() if len({inode for _, inode in group}) > 1]
+
+    saved = 0
+    with ThreadPoolExecutor() as pool:
+        for group in groups:
+            originals = {}
+            for (path, inode), digest in zip(group, pool.map(sha256_file, [path for path, _ in group])):
+                original, original_inode = originals.setdefault(digest, (path, inode))
+                if inode != original_inode:
+                    tmp_path = f"{path}.dedupe.{os.getpid()}"
+                    try:
+                        os.link(original, tmp_path)
+                        os.replace(tmp_path, path)
+                    except OSError:
+                        # fs.protected_hardlinks forbids linking to another user's files; leave the copy alone
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(tmp_path)
+                        continue
+                    saved += os.path.getsize(original)
+    return saved
+
+# Function to deduplicate the shared package cache and evict unused packages, least recently used first, down to a size budget
+def gc_package_cache(budget):
+    pkgs_dir = ensure_pkgs_dir()
+    record_package_refs()
+    saved = dedupe_package_cache(pkgs_dir)
+    live, last_referenced, unknown_since = package_refs(pkgs_dir)
+
+    entries = {}
+    for entry in os.scandir(pkgs_dir):
+        if entry.name.startswith(".") or entry.name in ("cache", "urls", "urls.txt"):
+            continue
+        # A package is cached both as its tarball and as its extracted directory
+        package = re.sub(r"(\.conda|\.tar\.bz2)$", "", entry.name)
+        info = entry.stat(follow_symlinks=False)
+        # atime is useless here since our own scans touch it, so recency is the download time
+        # or the last time an environment was seen using the package
+        record = entries.setdefault(package, {"paths": [], "size": 0, "cached": 0, "last_used": last_referenced.get(package, 0)})
+        record["paths"].append(entry.path)
+        record["size"] += dir_size(entry.path) if entry.is_dir(follow_symlinks=False) else info.st_size
+        record["cached"] = max(record["cached"], info.st_mtime)
+        record["last_used"] = max(record["last_used"], info.st_mtime)
+
+    total = sum(record["size"] for record in entries.values())
+    freed = 0
+    for package, record in sorted(entries.items(), key=lambda item: item[1]["last_used"]):
+        if total <= budget:
+            break
+        if package in live or record["cached"] >= unknown_since:
+            continue
+        for path in record["paths"]:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        total -= record["size"]
+        freed += record["size"]
+    click.echo(f"Package cache {pkgs_dir}: deduplicated {saved / 1e6:.1f} MB, evicted {freed / 1e6:.1f} MB, "
+               f"{total / 1e6:.1f} MB remaining ({len(live)} packages referenced).")
+    if total > budget:
+        click.echo("Warning: the remaining packages are referenced by environments or may be in use by another user, "
+                   "so the budget could not be met.")
+
+# Function to hold an exclusive lock on a file in the cache directory, yielding False if it is busy and non-blocking
+@contextlib.contextmanager
+def file_lock(name, blocking=True):
+    os.makedirs(CONFIG["cache_dir"], exist_ok=True)
+    with open(os.path.join(CONFIG["cache_dir"], name), "w") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+# Function to add or remove paths in the registry of trees waiting to be deleted, returning what is left
+def update_trash_registry(add=(), remove=()):
+    registry_path = os.path.join(CONFIG["cache_dir"], "trash.json")
+    with file_lock("trash.lock"):
+        paths = [path for path in read_json(registry_path, []) if path not in remove] + list(add)
+        write_json_atomic(registry_path, paths)
+    return paths
+
+# Function to rename a tree aside in one atomic step so it can be deleted later in the background
+def move_to_trash(path):
+    if not os.path.lexists(path):
+        return
+    trash_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path).lstrip('.')}.trash-{int(time.time())}-{os.getpid()}")
+    try:
+        os.rename(path, trash_path)
+    except OSError:
+        # Renames cannot cross filesystems, so fall back to deleting in place
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    update_trash_registry(add=[trash_path])
+
+# Function to delete a tree by spreading its second-level entries over a worker pool
+def delete_tree_parallel(path):
+    work, first_level_dirs = [], []
+    for entry in os.scandir(path) if os.path.isdir(path) else []:
+        if entry.is_dir(follow_symlinks=False):
+            work.extend(os.scandir(entry.path))
+            first_level_dirs.append(entry.path)
+        else:
+            work.append(entry)
+
+    def remove(entry):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry.path)
+
+    # Only second-level entries go to the pool; their now empty parents are removed once it joins
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(remove, work))
+    for dir_path in first_level_dirs:
+        shutil.rmtree(dir_path, ignore_errors=True)
+    shutil.rmtree(path, ignore_errors=True)
+
+# Function to delete every registered trash tree; safe to rerun after an interruption
+def purge_trash():
+    with file_lock("purge.lock", blocking=False) as acquired:
+        if not acquired:
+            return
+        # Re-read the registry until it is empty to pick up trees added while we were deleting
+        while True:
+            paths = update_trash_registry()
+            if not paths:
+                break
+            for path in paths:
+                delete_tree_parallel(path)
+                update_trash_registry(remove=[path])
+
+# Function to start purge_trash() in a detached process so the caller returns immediately
+def start_background_purge():
+    env = dict(os.environ, CONDA_SETUP_CACHE_DIR=CONFIG["cache_dir"])
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "--purge-trash"], env=env, start_new_session=True,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+# Function to remove a marked block from a shell rc file in-process, keeping a backup and writing atomically
+def remove_rc_block(file_path, begin_marker, end_marker):
+    # Resolve symlinks so dotfile managers keep pointing at the edited file
+    full_path = os.path.realpath(os.path.expanduser(file_path))
+    if not os.path.exists(full_path):
+        return False
+    with open(full_path, "r") as f:
+        file_content = f.read()
+    block = re.compile(rf"^{re.escape(begin_marker)}.*?^{re.escape(end_marker)}[^\n]*\n?", re.S | re.M)
+    new_content = block.sub("", file_content)
+    if new_content == file_content:
+        return False
+    shutil.copy2(full_path, full_path + ".conda-setup.bak")
+    tmp_path = f"{full_path}.tmp.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        f.write(new_content)
+    shutil.copymode(full_path, tmp_path)
+    os.replace(tmp_path, full_path)
+    return True
+
+PACK_METADATA = ".conda-setup-pack.json"
+
+# Function to list the files in a prefix that embed the prefix path and must be rewritten on relocation
+def prefix_dependent_files(prefix):
+    files = {}
+    meta_dir = os.path.join(prefix, "conda-meta")
+    for record in os.listdir(meta_dir):
+        if record.endswith(".json"):
+            # conda records every file it rewrote at install time, with whether it is text or binary
+            for path in read_json(os.path.join(meta_dir, record), {}).get("paths_data", {}).get("paths", []):
+                if path.get("prefix_placeholder"):
+                    files[path["_path"]] = path.get("file_mode", "text")
+    # Scripts written by pip are not in conda-meta, but their shebangs point into the prefix too
+    bin_dir = os.path.join(prefix, "bin")
+    for entry in os.scandir(bin_dir) if os.path.isdir(bin_dir) else []:
+        if entry.is_file(follow_symlinks=False):
+            with open(entry.path, "rb") as f:
+                first_line = f.readline(4096)
+            if first_line.startswith(b"#!") and prefix.encode() in first_line:
+                files.setdefault(f"bin/{entry.name}", "text")
+    return files
+
+# Function to export an environment as one streamed tar archive, compressed by a parallel zstd process
+def export_env(env_name, archive_path):
+    envs = {env["name"]: env for env in load_env_index()}
+    if env_name not in envs:
+        raise click.ClickException(f"No environment named '{env_name}'.")
+    prefix = envs[env_name]["prefix"]
+    metadata = json.dumps({"name": env_name, "prefix": prefix, "created": time.time(), "relocate": prefix_dependent_files(prefix)}).encode()
+
+    click.echo(f"Exporting '{env_name}' to {archive_path}...")
+    started = time.time()
+    with open(archive_path, "wb") as out, phase("export", env=env_name):
+        if shutil.which("zstd"):
+            compressor = subprocess.Popen(["zstd", "-T0", "-q", "-c"], stdin=subprocess.PIPE, stdout=out)
+            tar = tarfile.open(fileobj=compressor.stdin, mode="w|")
+        else:
+            click.echo("Warning: zstd not found, falling back to single-threaded gzip.")
+            compressor = None
+            tar = tarfile.open(fileobj=out, mode="w|gz")
+        with tar:
+            # The metadata goes first so an import can read it before any files arrive
+            info = tarfile.TarInfo(PACK_METADATA)
+            info.size, info.mtime = len(metadata), time.time()
+            tar.addfile(info, io.BytesIO(metadata))
+            tar.add(prefix, arcname=".")
+        if compressor:
+            compressor.stdin.close()
+            if compressor.wait():
+                raise click.ClickException(f"zstd exited with status {compressor.returncode}.")
+    click.echo(f"Exported {os.path.getsize(archive_path) / 1e6:.1f} MB in {time.time() - started:.1f}s.")
+
+# Function to rewrite an old prefix in one file, padding binary strings with NULs the way conda does
+def relocate_file(path, old_prefix, new_prefix, file_mode):
+    with open(path, "rb") as f:
+        data = f.read()
+    old, new = old_prefix.encode(), new_prefix.encode()
+    if file_mode == "binary":
+        if len(new) > len(old):
+            click.echo(f"Warning: cannot relocate binary {path}, the new prefix is longer than the old one.")
+            return
+        # Keep every C string the same length so offsets inside the binary do not move
+        pattern = re.compile(re.escape(old) + rb"([^\0]*?)\0")
+        new_data = pattern.sub(lambda match: new + match.group(1) + b"\0" * (len(old) - len(new) + 1), data)
+    else:
+        new_data = data.replace(old, new)
+    if new_data != data:
+        mode = os.stat(path).st_mode
+        # Files may be hardlinks into the package cache, so write a new inode instead of editing in place
+        tmp_path = f"{path}.relocate.{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            f.write(new_data)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+
+# Function to register a prefix in ~/.conda/environments.txt the way conda create does, so conda and our index both see it
+def register_env_prefix(prefix):
+    environments_txt = os.path.expanduser("~/.conda/environments.txt")
+    os.makedirs(os.path.dirname(environments_txt), exist_ok=True)
+    try:
+        with open(environments_txt, "r") as f:
+            if prefix in (line.strip() for line in f):
+                return
+    except FileNotFoundError:
+        pass
+    with open(environments_txt, "a") as f:
+        f.write(prefix + "\n")
+
+# Function to restore an exported environment, decompressing and extracting as a stream, then relocating it
+def import_env(archive_path, env_name=None):
+    with open(archive_path, "rb") as f:
+        is_zstd = f.read(4) == b"\x28\xb5\x2f\xfd"
+    if is_zstd and not shutil.which("zstd"):
+        raise click.ClickException("This archive is zstd-compressed but zstd is not installed.")
+
+    root = find_conda_root()
+    if not root:
+        raise click.ClickException("Conda is not installed.")
+    started = time.time()
+    decompressor = subprocess.Popen(["zstd", "-dc", archive_path], stdout=subprocess.PIPE) if is_zstd else None
+    with phase("import", archive=archive_path):
+        tar = tarfile.open(fileobj=decompressor.stdout, mode="r|") if decompressor else tarfile.open(archive_path, mode="r|gz")
+        with tar:
+            first = tar.next()
+            if not first or first.name != PACK_METADATA:
+                raise click.ClickException(f"{archive_path} is not an environment archive made by --export.")
+            metadata = json.load(tar.extractfile(first))
+            # Restore to the original prefix when it is free so nothing needs relocating, e.g. after a reinstall
+            if (not env_name or env_name == metadata["name"]) and not os.path.lexists(metadata["prefix"]):
+                env_name, prefix = metadata["name"], metadata["prefix"]
+            else:
+                env_name = env_name or metadata["name"]
+                prefix = os.path.join(root, "envs", env_name)
+            if os.path.exists(prefix):
+                raise click.ClickException(f"Environment '{env_name}' already exists at {prefix}.")
+            click.echo(f"Importing '{metadata['name']}' as '{env_name}' into {prefix}...")
+            # The remaining members extract as they are decompressed, without staging the archive
+            extract_filter = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+            try:
+                for member in tar:
+                    if member.name != PACK_METADATA:
+                        tar.extract(member, prefix, **extract_filter)
+            except BaseException:
+                shutil.rmtree(prefix, ignore_errors=True)
+                raise
+        if decompressor and decompressor.wait():
+            raise click.ClickException(f"zstd exited with status {decompressor.returncode}.")
+
+    with phase("relocate", env=env_name):
+        if metadata["prefix"] != prefix:
+            for relative_path, file_mode in metadata["relocate"].items():
+                path = os.path.join(prefix, relative_path)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    relocate_file(path, metadata["prefix"], prefix, file_mode)
+
+    register_env_prefix(prefix)
+    refresh_activation_scripts()
+    click.echo(f"Imported '{env_name}' in {time.time() - started:.1f}s.")
+
+# Function to list one directory for the scanner, or return None if its mtime shows it is unchanged
+def scan_dir(path, cached_mtime):
+    try:
+        mtime = os.lstat(path).st_mtime_ns
+    except OSError:
+        return path, None
+    if mtime == cached_mtime:
+        return path, None
+    result = {"mtime_ns": mtime, "bytes": 0, "files": 0, "subdirs": [], "links": []}
+    seen_inodes = set()
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                result["subdirs"].append(entry.name)
+                continue
+            info = entry.stat(follow_symlinks=False)
+            result["files"] += 1
+            # Hardlinked files are recorded by inode so each one is counted once however many names it has
+            if info.st_nlink > 1:
+                if (info.st_dev, info.st_ino) not in seen_inodes:
+                    seen_inodes.add((info.st_dev, info.st_ino))
+                    result["links"].append((info.st_dev, info.st_ino, info.st_size))
+            else:
+                result["bytes"] += info.st_size
+    return path, result
+
+# Function to open the incremental scan index, a SQLite database since it holds every hardlinked inode
+def open_scan_index():
+    os.makedirs(CONFIG["cache_dir"], exist_ok=True)
+    db = sqlite3.connect(os.path.join(CONFIG["cache_dir"], "scan-index.sqlite"))
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, prefix TEXT, mtime_ns INTEGER, bytes INTEGER, files INTEGER, subdirs TEXT);
+        CREATE TABLE IF NOT EXISTS links (dir TEXT, dev INTEGER, ino INTEGER, size INTEGER);
+        CREATE INDEX IF NOT EXISTS links_dir ON links (dir);
+        CREATE TABLE IF NOT EXISTS envs (prefix TEXT PRIMARY KEY, fingerprint INTEGER, verified INTEGER, issues TEXT);
+    """)
+    return db
+
+# Function to walk every prefix with parallel scandir workers, rescanning only directories whose mtime changed
+def walk_prefixes(db, prefixes, skip):
+    cached = {path: (mtime, json.loads(subdirs)) for path, mtime, subdirs in db.execute("SELECT path, mtime_ns, subdirs FROM dirs")}
+    owner = {prefix: prefix for prefix in prefixes}
+    visited, changed_prefixes = set(), set()
+    with ThreadPoolExecutor(max_workers=CONFIG["scan_workers"]) as pool, db:
+        pending = {pool.submit(scan_dir, prefix, cached.get(prefix, (None,))[0]) for prefix in prefixes}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, result = future.result()
+                if path not in cached and result is None:
+                    continue
+                visited.add(path)
+                if result is None:
+                    subdirs = cached[path][1]
+                else:
+                    subdirs = result["subdirs"]
+                    changed_prefixes.add(owner[path])
+                    db.execute("REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?)",
+                               (path, owner[path], result["mtime_ns"], result["bytes"], result["files"], json.dumps(subdirs)))
+                    db.execute("DELETE FROM links WHERE dir = ?", (path,))
+                    db.executemany("INSERT INTO links VALUES (?, ?, ?, ?)", [(path, *link) for link in result["links"]])
+                for name in subdirs:
+                    child = os.path.join(path, name)
+                    # Named environments inside the base prefix are scanned as their own prefixes
+                    if child not in skip:
+                        owner[child] = owner[path]
+                        pending.add(pool.submit(scan_dir, child, cached.get(child, (None,))[0]))
+
+        # Directories that were not reached any more have been deleted
+        removed = [(path,) for path in cached if path not in visited]
+        db.executemany("DELETE FROM dirs WHERE path = ?", removed)
+        db.executemany("DELETE FROM links WHERE dir = ?", removed)
+    return changed_prefixes
+
+# Function to compare an environment's files against its conda-meta manifests, optionally checking hashes
+def check_env_integrity(prefix, verify_hashes):
+    issues = []
+    meta_dir = os.path.join(prefix, "conda-meta")
+    for record in sorted(os.listdir(meta_dir)):
+        if not record.endswith(".json"):
+            continue
+        manifest = read_json(os.path.join(meta_dir, record), {})
+        # Older records only list file names, without sizes or hashes
+        paths = manifest.get("paths_data", {}).get("paths") or [{"_path": path} for path in manifest.get("files", [])]
+        for path in paths:
+            if path.get("path_type") == "directory":
+                continue
+            full_path = os.path.join(prefix, path["_path"])
+            try:
+                info = os.lstat(full_path)
+            except FileNotFoundError:
+                issues.append({"package": record[:-5], "path": path["_path"], "problem": "missing"})
+                continue
+            if stat.S_ISLNK(info.st_mode):
+                continue
+            # Files rewritten for the prefix no longer match the package's size or sha256
+            relocated = bool(path.get("prefix_placeholder"))
+            if path.get("size_in_bytes") is not None and not relocated and info.st_size != path["size_in_bytes"]:
+                issues.append({"package": record[:-5], "path": path["_path"], "problem": f"size {info.st_size} != {path['size_in_bytes']}"})
+            elif verify_hashes:
+                expected = path.get("sha256_in_prefix") or (None if relocated else path.get("sha256"))
+                if expected and sha256_file(full_path) != expected:
+                    issues.append({"package": record[:-5], "path": path["_path"], "problem": "sha256 mismatch"})
+    return issues
+
+# Function to report every environment's disk usage, staleness and integrity, reusing the index for unchanged trees
+def scan_envs(verify_hashes, stale_days, report_path):
+    envs = load_env_index()
+    prefixes = {env["prefix"] for env in envs}
+    root = find_conda_root()
+    skip = prefixes | ({os.path.join(root, "envs"), os.path.join(root, "pkgs")} if root else set())
+    db = open_scan_index()
+    started = time.time()
+    with phase("scan_walk"):
+        changed_prefixes = walk_prefixes(db, prefixes, skip)
+
+    # Integrity is rechecked only for environments whose files or manifests changed since the last scan
+    cached_envs = {prefix: (fingerprint, verified, issues) for prefix, fingerprint, verified, issues in db.execute("SELECT * FROM envs")}
+    to_check = [env for env in envs if env["prefix"] in changed_prefixes or env["prefix"] not in cached_envs
+                or cached_envs[env["prefix"]][0] != env["fingerprint"] or (verify_hashes and not cached_envs[env["prefix"]][1])]
+    with phase("scan_integrity", envs=len(to_check)), ThreadPoolExecutor(max_workers=CONFIG["scan_workers"]) as pool, db:
+        for env, issues in zip(to_check, pool.map(lambda env: check_env_integrity(env["prefix"], verify_hashes), to_check)):
+            cached_envs[env["prefix"]] = (env["fingerprint"], int(verify_hashes), json.dumps(issues))
+            db.execute("REPLACE INTO envs VALUES (?, ?, ?, ?)", (env["prefix"], *cached_envs[env["prefix"]]))
+        db.executemany("DELETE FROM envs WHERE prefix = ?", [(prefix,) for prefix in cached_envs if prefix not in prefixes])
+
+    usage = {prefix: [plain, files, 0] for prefix, plain, files in db.execute("SELECT prefix, SUM(bytes), SUM(files) FROM dirs GROUP BY prefix")}
+    for prefix, linked in db.execute("""SELECT prefix, SUM(size) FROM (SELECT DISTINCT d.prefix, l.dev, l.ino, l.size
+                                        FROM links l JOIN dirs d ON l.dir = d.path) GROUP BY prefix"""):
+        usage[prefix][2] = linked
+    (all_linked,), = db.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT dev, ino, size FROM links)")
+    db.close()
+
+    report = []
+    for env in envs:
+        plain, files, linked = usage.get(env["prefix"], (0, 0, 0))
+        age_days = (time.time() - env["updated"]) / 86400 if env["updated"] else None
+        issues = json.loads(cached_envs[env["prefix"]][2])
+        report.append({
+            "name": env["name"], "prefix": env["prefix"], "size": plain + linked, "shared": linked, "files": files,
+            "age_days": round(age_days, 1) if age_days is not None else None,
+            "stale": age_days is not None and age_days > stale_days, "issues": issues,
+        })
+    report.sort(key=lambda entry: entry["size"], reverse=True)
+
+    for entry in report:
+        flags = ", ".join(filter(None, ["stale" if entry["stale"] else "", f"{len(entry['issues'])} integrity issue(s)" if entry["issues"] else ""]))
+        age = f"{entry['age_days']:.0f}d" if entry["age_days"] is not None else "-"
+        click.echo(f"{entry['size'] / 1e6:10.1f} MB  {entry['shared'] / 1e6:10.1f} MB shared  {age:>6}  {entry['name']}" + (f"  [{flags}]" if flags else ""))
+    total = sum(usage[prefix][0] for prefix in usage) + all_linked
+    click.echo(f"{len(report)} environments, {total / 1e6:.1f} MB on disk with hardlinks counted once "
+               f"({len(changed_prefixes)} rescanned, {len(to_check)} integrity-checked in {time.time() - started:.1f}s).")
+    if report_path:
+        write_json_atomic(os.path.abspath(report_path), {"time": time.time(), "total": total, "environments": report})
 
 # Function to reinstall Conda
 def reinstall_conda():
     click.echo("Reinstalling Conda...")
-    subprocess.run(["rm", "-rf", os.path.expanduser("~/miniconda"), os.path.expanduser("~/.conda")], check=True)
+    backup_dir = os.path.join(CONFIG["cache_dir"], "backups")
+    backups = []
+    # Only environments inside the trees about to be trashed need a backup; ones registered elsewhere
+    # (conda create -p /data/envs/x) stay where they are and only need registering again
+    trashed = [os.path.realpath(os.path.expanduser(path)) for path in ("~/miniconda", "~/.conda")]
+    envs, kept = [], []
+    for env in load_env_index():
+        inside = any(os.path.commonpath([os.path.realpath(env["prefix"]), tree]) == tree for tree in trashed)
+        if env["name"] != "base" and inside:
+            envs.append(env)
+        elif not inside:
+            kept.append(env["prefix"])
+    if envs and click.confirm(f"Back up {len(envs)} environment(s) to {backup_dir} first?", default=False):
+        os.makedirs(backup_dir, exist_ok=True)
+        for env in envs:
+            backups.append(os.path.join(backup_dir, f"{env['name']}.tar.zst"))
+            export_env(env["name"], backups[-1])
+
+    # Rename the old trees aside and delete them in the background while the new prefix installs
+    with phase("trash"):
+        move_to_trash(os.path.expanduser("~/miniconda"))
+        move_to_trash(os.path.expanduser("~/.conda"))
+        start_background_purge()
+    for prefix in kept:
+        register_env_prefix(prefix)
     install_conda()
+    for archive_path in backups:
+        import_env(archive_path)
     reinit_shell()
     raise SystemExit(0)
 
@@ -101,23 +1489,18 @@ def uninstall_conda():
     click.confirm("This action will uninstall Conda and its dependencies. Do you want to proceed?", abort=True)
     click.echo("Uninstalling Conda and its dependencies...")
 
-    # Remove the Miniconda installation directory
-    miniconda_dir = os.path.expanduser("~/miniconda")
-    if os.path.exists(miniconda_dir):
-        shutil.rmtree(miniconda_dir)
-
-    # Remove the user-specific configuration directory
-    shutil.rmtree(os.path.expanduser("~/.conda"), ignore_errors=True)
+    # Rename the Miniconda installation and user configuration aside; they are deleted in the background
+    with phase("trash"):
+        move_to_trash(os.path.expanduser("~/miniconda"))
+        move_to_trash(os.path.expanduser("~/.conda"))
+        start_background_purge()
 
     # Remove any Conda-related initialization scripts from .bashrc or .bash_profile
     bash_files = ["~/.bashrc", "~/.bash_profile"]
-    for file_path in bash_files:
-        full_path = os.path.expanduser(file_path)
-        if os.path.exists(full_path):
-            with open(full_path, "r") as f:
-                file_content = f.read()
-            if "conda initialize" in file_content:
-                subprocess.run(["sed", "-i", "/# >>> conda initialize >>>/,/# <<< conda initialize <<</d", full_path], check=True)
+    with phase("rc_edit"):
+        for file_path in bash_files:
+            remove_rc_block(file_path, "# >>> conda initialize >>>", "# <<< conda initialize <<<")
+            remove_rc_block(file_path, ACTIVATION_BEGIN, ACTIVATION_END)
 
     click.echo("Uninstallation completed successfully.")
     reinit_shell()
@@ -130,11 +1513,113 @@ def reinit_shell():
     subprocess.run(["bash", "-c", "source ~/.bashrc"])
 
 @click.command()
-def main():
+@click.option("--offline", is_flag=True, help="Install Conda only from the local installer cache.")
+@click.option("--keep-installers", default=3, show_default=True, help="Number of cached installer versions to keep.")
+@click.option("--installer-url", default=CONFIG["installer_url"], show_default=True, help="Miniconda installer URL, e.g. an internal mirror.")
+@click.option("--installer-sha256", default=CONFIG["installer_sha256"], help="Expected installer SHA-256, for mirrors without an index page.")
+@click.option("--download-workers", default=8, show_default=True, help="Number of concurrent range requests used to download the installer.")
+@click.option("--spec", "spec_path", type=click.Path(exists=True, dir_okay=False), help="Create or update the environments listed in a YAML/JSON spec without prompting.")
+@click.option("--jobs", type=int, default=None, help="Number of environments provisioned in parallel with --spec. [default: the spec's jobs, else 4]")
+@click.option("--summary", "summary_path", default="provision-summary.json", show_default=True, help="Where --spec writes its per-environment JSON summary.")
+@click.option("--lock-ttl-days", default=7.0, show_default=True, help="How long a cached solver lockfile is reused; 0 disables the cache.")
+@click.option("--refresh", is_flag=True, help="Ignore cached solver lockfiles and solve again, refreshing the cache.")
+@click.option("--register-template", "template_env", metavar="ENV_NAME", help="Register an existing environment as a golden template and exit.")
+@click.option("--pkgs-dir", help="Shared package cache used by every conda command this tool runs; remembered for later runs. "
+                                 "[default: $CONDA_SETUP_PKGS_DIR, else the last --pkgs-dir, else ~/.cache/conda-setup/pkgs]")
+@click.option("--templates", "templates_file", default=CONFIG["templates_path"], help="Template registry shared by all users. [default: .templates.json in --pkgs-dir]")
+@click.option("--gc-pkgs", is_flag=True, help="Deduplicate the shared package cache, evict unused packages down to --pkgs-budget and exit.")
+@click.option("--pkgs-budget", default="50G", show_default=True, help="Size the package cache is trimmed to by --gc-pkgs.")
+@click.option("--backend", type=click.Choice(["auto", *BACKEND_ORDER]), default="auto", show_default=True,
+              help="Solver/installer to use; auto picks the fastest available one for each operation.")
+@click.option("--bootstrap", type=click.Choice(["miniconda", "micromamba"]), default="miniconda", show_default=True,
+              help="Install the full Miniconda installer or just the static micromamba binary.")
+@click.option("--export", "export_name", metavar="ENV_NAME", help="Export an environment to --archive and exit.")
+@click.option("--import", "import_path", type=click.Path(exists=True, dir_okay=False), help="Restore an environment archive made by --export and exit.")
+@click.option("--archive", "archive_path", type=click.Path(dir_okay=False), help="Archive written by --export [default: ENV_NAME.tar.zst].")
+@click.option("--import-name", help="Name for the environment restored by --import [default: its original name].")
+@click.option("--scan", is_flag=True, help="Report disk usage, staleness and integrity of every environment and exit.")
+@click.option("--verify-hashes", is_flag=True, help="With --scan, also check file SHA-256s against the conda-meta manifests.")
+@click.option("--stale-days", default=90, show_default=True, help="With --scan, flag environments untouched for this many days.")
+@click.option("--scan-report", type=click.Path(dir_okay=False), help="With --scan, also write the full report as JSON.")
+@click.option("--worker", "use_worker", is_flag=True, help="Route conda commands through a persistent worker that keeps conda loaded.")
+@click.option("--worker-idle-timeout", default=600, show_default=True, help="Seconds an idle worker waits before exiting.")
+@click.option("--trace", "trace_path", type=click.Path(dir_okay=False), help="Write per-phase timing spans to this file on exit.")
+@click.option("--trace-format", type=click.Choice(["json", "chrome"]), default="json", show_default=True, help="Plain JSON spans or Chrome trace events.")
+@click.option("--refresh-activation", is_flag=True, hidden=True, help="Regenerate stale static activation scripts and exit.")
+@click.option("--purge-trash", "purge_only", is_flag=True, hidden=True, help="Delete trees left behind by uninstall/reinstall and exit.")
+def main(offline, keep_installers, installer_url, installer_sha256, download_workers, spec_path, jobs, summary_path, lock_ttl_days, refresh, template_env, pkgs_dir, templates_file, gc_pkgs, pkgs_budget, backend, bootstrap, export_name, import_path, archive_path, import_name, scan, verify_hashes, stale_days, scan_report, use_worker, worker_idle_timeout, trace_path, trace_format, refresh_activation, purge_only):
+    if trace_path:
+        # Registered first so the trace is written however main() exits
+        atexit.register(write_trace, trace_path, trace_format)
+    CONFIG["offline"] = offline
+    CONFIG["keep_installers"] = keep_installers
+    CONFIG["installer_url"] = installer_url
+    CONFIG["installer_sha256"] = installer_sha256
+    CONFIG["download_workers"] = download_workers
+    CONFIG["jobs"] = jobs
+    CONFIG["lock_ttl_days"] = lock_ttl_days
+    CONFIG["refresh_locks"] = refresh
+    CONFIG["use_worker"] = use_worker
+    CONFIG["backend"] = backend
+    CONFIG["bootstrap"] = bootstrap
+    CONFIG["worker_idle_timeout"] = worker_idle_timeout
+    # The package cache is usually shared, so remember it rather than making every run pass --pkgs-dir
+    settings_path = os.path.join(CONFIG["cache_dir"], "settings.json")
+    settings = read_json(settings_path, {})
+    if pkgs_dir:
+        pkgs_dir = os.path.abspath(os.path.expanduser(pkgs_dir))
+        if settings.get("pkgs_dir") != pkgs_dir:
+            write_json_atomic(settings_path, dict(settings, pkgs_dir=pkgs_dir))
+    elif not os.environ.get("CONDA_SETUP_PKGS_DIR"):
+        pkgs_dir = settings.get("pkgs_dir")
+    CONFIG["pkgs_dir"] = os.path.abspath(os.path.expanduser(pkgs_dir or CONFIG["pkgs_dir"]))
+    CONFIG["templates_path"] = templates_file
+    ensure_pkgs_dir()
+    # conda reads CONDA_PKGS_DIRS, so every conda call we spawn shares the same cache
+    os.environ["CONDA_PKGS_DIRS"] = CONFIG["pkgs_dir"]
+
+    if purge_only:
+        purge_trash()
+        raise SystemExit(0)
+    if refresh_activation:
+        refresh_activation_scripts()
+        raise SystemExit(0)
+    # Resume deleting trees left behind by an interrupted uninstall or reinstall
+    if read_json(os.path.join(CONFIG["cache_dir"], "trash.json"), []):
+        start_background_purge()
+
+    if gc_pkgs:
+        gc_package_cache(parse_size(pkgs_budget))
+        raise SystemExit(0)
+    if scan:
+        scan_envs(verify_hashes, stale_days, scan_report)
+        raise SystemExit(0)
+    if export_name:
+        export_env(export_name, archive_path or f"{export_name}.tar.zst")
+        raise SystemExit(0)
+    if import_path:
+        import_env(import_path, import_name)
+        raise SystemExit(0)
+
+    if template_env:
+        register_template(template_env)
+        raise SystemExit(0)
+
+    # Batch mode never prompts: install Conda if needed, provision the spec and exit
+    if spec_path:
+        if not check_conda_installed():
+            install_conda()
+        provision_from_spec(spec_path, summary_path)
+        raise SystemExit(0)
+
     # Check if Conda is installed
     existing_conda_path = check_conda_installed()
     if existing_conda_path:
         click.echo(f"Miniconda is already installed at: {existing_conda_path}")
+        # Installs from before the static activation scripts still run conda's Python in every new shell
+        if activation_hook_outdated() and click.confirm("Replace the conda init hook in ~/.bashrc with static activation scripts?", default=True):
+            install_activation_hook(find_conda_root() or os.path.expanduser("~/miniconda"))
+            click.echo("Open a new shell to pick up the new hook.")
     else:
         prompt_install_or_exit()
     # Prompt the user to select an action
@@ -0,0 +1,385 @@
+import os
+import sys
+import json
+import hashlib
+import click
+import pytest
+import install
+from bench import start_mirror, FAKE_CONDA
+
+
+@pytest.fixture
+def mirror(tmp_path, monkeypatch):
+    mirror_dir = tmp_path / "mirror"
+    mirror_dir.mkdir()
+    payload = os.urandom(10 * 64 * 1024 + 123)
+    (mirror_dir / "installer.sh").write_bytes(payload)
+    server = start_mirror(str(mirror_dir))
+    monkeypatch.setitem(install.CONFIG, "download_chunk_size", 64 * 1024)
+    monkeypatch.setitem(install.CONFIG, "download_workers", 4)
+    yield f"http://127.0.0.1:{server.server_port}/installer.sh", payload
+    server.shutdown()
+
+
+@pytest.fixture
+def conda_home(tmp_path, monkeypatch):
+    home = tmp_path / "home"
+    bin_dir = home / "miniconda" / "bin"
+    bin_dir.mkdir(parents=True)
+    (home / "miniconda" / "conda-meta").mkdir()
+    (home / "miniconda" / "conda-meta" / "history").touch()
+    (bin_dir / "conda").write_text(FAKE_CONDA.format(python=sys.executable))
+    (bin_dir / "conda").chmod(0o755)
+    for key in ("CONDA_EXE", "CONDA_PREFIX", "CONDA_SHLVL"):
+        monkeypatch.delenv(key, raising=False)
+    monkeypatch.setenv("HOME", str(home))
+    monkeypatch.setenv("PATH", f"{bin_dir}:/usr/bin:/bin")
+    monkeypatch.setenv("FAKE_CONDA_SOLVE_SECONDS", "0")
+    # Every test gets its own copy of the runtime options, pointed into its home
+    monkeypatch.setattr(install, "CONFIG", dict(install.CONFIG, cache_dir=str(home / ".cache" / "conda-setup"),
+                                                 pkgs_dir=str(tmp_path / "pkgs")))
+    return home
+
+
+# Test that a ranged download reassembles the file and hashes it while the chunks arrive
+def test_download_file_ranges(mirror, tmp_path):
+    url, payload = mirror
+    dest_path = str(tmp_path / "installer.sh")
+    assert install.download_file(url, dest_path) == hashlib.sha256(payload).hexdigest()
+    with open(dest_path, "rb") as f:
+        assert f.read() == payload
+    assert not os.path.exists(dest_path + ".state")
+
+
+# Test that a failed chunk leaves a state file and the next run fetches only the chunks still missing
+def test_download_file_resumes(mirror, tmp_path, monkeypatch):
+    url, payload = mirror
+    dest_path = str(tmp_path / "installer.sh")
+    real_download_range = install.download_range
+    landed = []
+
+    def flaky_download_range(url, fd, start, end, retries=3):
+        if start == 3 * 64 * 1024:
+            raise OSError("connection reset")
+        fetched = real_download_range(url, fd, start, end, retries)
+        landed.append(start // (64 * 1024))
+        return fetched
+
+    monkeypatch.setattr(install, "download_range", flaky_download_range)
+    with pytest.raises(OSError):
+        install.download_file(url, dest_path)
+    with open(dest_path + ".state") as f:
+        done = json.load(f)["done"]
+    assert sorted(done) == sorted(landed) and 3 not in done
+
+    fetched = []
+
+    def counting_download_range(url, fd, start, end, retries=3):
+        fetched.append(start // (64 * 1024))
+        return real_download_range(url, fd, start, end, retries)
+
+    monkeypatch.setattr(install, "download_range", counting_download_range)
+    assert install.download_file(url, dest_path) == hashlib.sha256(payload).hexdigest()
+    assert sorted(fetched) == sorted(set(range(11)) - set(done))
+    with open(dest_path, "rb") as f:
+        assert f.read() == payload
+
+
+# Test that an unquoted YAML version, which loads as a float, is rejected instead of provisioning python=3.1
+def test_load_spec_rejects_float_python(tmp_path):
+    spec_path = tmp_path / "envs.yaml"
+    spec_path.write_text("environments:\n  ml:\n    python: 3.10\n")
+    with pytest.raises(click.ClickException, match="quoted string"):
+        install.load_spec(str(spec_path))
+    spec_path.write_text("environments:\n  ml:\n    python: '3.10'\n")
+    assert install.load_spec(str(spec_path))[1] == [{"name": "ml", "python": "3.10"}]
+
+
+# Test that one bad entry fails alone, the summary is still written, and reruns leave empty entries unchanged
+def test_provision_from_spec_summary(conda_home, tmp_path):
+    spec_path = tmp_path / "spec.json"
+    spec_path.write_text(json.dumps({"environments": [
+        {"name": "ml", "python": "3.11", "packages": ["numpy"]},
+        {"name": "bare"},
+        {"name": "bad", "template": "missing"},
+    ]}))
+    summary_path = tmp_path / "summary.json"
+    with pytest.raises(click.ClickException, match="1 environment"):
+        install.provision_from_spec(str(spec_path), str(summary_path))
+    results = {result["name"]: result for result in json.loads(summary_path.read_text())["environments"]}
+    assert results["ml"]["status"] == results["bare"]["status"] == "ok"
+    assert results["bad"]["status"] == "failed" and "missing" in results["bad"]["error"]
+    assert (conda_home / "miniconda" / "envs" / "ml" / "conda-meta" / "numpy-1.0-0.json").exists()
+
+    with pytest.raises(click.ClickException):
+        install.provision_from_spec(str(spec_path), str(summary_path))
+    results = {result["name"]: result for result in json.loads(summary_path.read_text())["environments"]}
+    assert (results["ml"]["action"], results["bare"]["action"]) == ("updated", "unchanged")
+    assert results["bare"]["status"] == "ok"
+
+
+# Test that the lockfile key ignores package order and spacing but not channel order
+def test_lockfile_path_normalizes_packages(conda_home):
+    assert install.lockfile_path(["NumPy", "python = 3.11"], ["conda-forge"]) == install.lockfile_path(["python=3.11", "numpy"], ["conda-forge"])
+    assert install.lockfile_path(["numpy"], ["a", "b"]) != install.lockfile_path(["numpy"], ["b", "a"])
+
+
+# Test that threads creating environments from the same spec never trip over each other's lockfile writes
+def test_create_env_threads_share_lockfile(conda_home, monkeypatch):
+    names = [f"env{i}" for i in range(8)]
+    real_run_conda = install.run_conda
+    barrier = install.threading.Barrier(len(names))
+
+    def run_conda(args, capture=False):
+        result = real_run_conda(args, capture)
+        # Line all threads up right before they write the lockfile
+        if args[0] == "list":
+            barrier.wait(timeout=30)
+        return result
+
+    monkeypatch.setattr(install, "run_conda", run_conda)
+    with install.ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda name: install.create_env(name, ["numpy"], capture=True), names))
+    lock_path = install.lockfile_path(["numpy"], [])
+    assert open(lock_path).read().startswith("# spec: numpy\n")
+    assert not [name for name in os.listdir(os.path.dirname(lock_path)) if ".tmp." in name]
+    assert "from cached lockfile" in install.create_env("again", ["numpy"], capture=True)
+
+
+# Test that a lockfile which fails before a prefix exists falls back to a solve and is replaced
+def test_create_env_lockfile_fallback(conda_home, monkeypatch):
+    install.create_env("first", ["numpy"], capture=True)
+    real_run_conda = install.run_conda
+
+    def run_conda(args, capture=False):
+        # Stand in for a channel that dropped a build, and for conda refusing to remove a missing prefix
+        if "--file" in args or args[0] == "remove":
+            raise install.subprocess.CalledProcessError(1, args, output="PackagesNotFoundError\n")
+        return real_run_conda(args, capture)
+
+    monkeypatch.setattr(install, "run_conda", run_conda)
+    output = install.create_env("second", ["numpy"], capture=True)
+    assert "solving from scratch" in output
+    assert (conda_home / "miniconda" / "envs" / "second" / "conda-meta" / "numpy-1.0-0.json").exists()
+    assert os.path.exists(install.lockfile_path(["numpy"], []))
+
+
+# Test that a template registered by one user is visible to another user sharing the package cache
+def test_templates_shared_through_pkgs_dir(conda_home, tmp_path):
+    install.create_env("gold", ["numpy"], capture=True)
+    install.register_template("gold")
+    assert os.path.exists(tmp_path / "pkgs" / ".templates.json")
+
+    install.CONFIG["cache_dir"] = str(tmp_path / "other-user-cache")
+    assert "gold" in install.load_templates()
+    install.create_env("mine", template="gold", capture=True)
+    assert (conda_home / "miniconda" / "envs" / "mine" / "conda-meta" / "numpy-1.0-0.json").exists()
+
+
+# Test that GC only evicts packages nobody can still be using, even when another user's home is unreadable
+def test_gc_never_evicts_live_packages(conda_home, tmp_path, monkeypatch):
+    pkgs_dir = tmp_path / "pkgs"
+    (pkgs_dir / ".refs").mkdir(parents=True)
+    old = install.time.time() - 1000
+    for package in ("hidden-1-0", "gone-1-0", "unused-1-0", "new-1-0"):
+        (pkgs_dir / package).mkdir()
+        (pkgs_dir / package / "data").write_bytes(os.urandom(1000))
+        if package != "new-1-0":
+            os.utime(pkgs_dir / package, (old, old))
+    # Another user recorded their references 500s ago; new-1-0 was cached after that
+    (pkgs_dir / ".refs" / "1000-other.json").write_text(json.dumps({
+        "home": "/home/other", "updated": install.time.time() - 500,
+        "packages": {"hidden-1-0": ["/home/other/envs/a"], "gone-1-0": [str(tmp_path / "removed-env")]},
+    }))
+    real_stat = os.stat
+
+    def stat(path, *args, **kwargs):
+        if str(path).startswith("/home/other"):
+            raise PermissionError(13, "Permission denied", path)
+        return real_stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(install.os, "stat", stat)
+    install.gc_package_cache(0)
+    assert sorted(name for name in os.listdir(pkgs_dir) if not name.startswith(".")) == ["hidden-1-0", "new-1-0"]
+
+
+# Test that an unreadable refs file protects the whole cache
+def test_gc_unreadable_refs_evicts_nothing(conda_home, tmp_path):
+    pkgs_dir = tmp_path / "pkgs"
+    (pkgs_dir / ".refs").mkdir(parents=True)
+    (pkgs_dir / "unused-1-0").mkdir()
+    (pkgs_dir / ".refs" / "1000-other.json").write_text("{not json")
+    install.gc_package_cache(0)
+    assert (pkgs_dir / "unused-1-0").exists()
+
+
+# Test that a shared (setgid) cache keeps what this process and its conda children create group-writable
+def test_shared_pkgs_dir_group_umask(conda_home):
+    previous = os.umask(0o022)
+    try:
+        install.ensure_pkgs_dir()
+        assert os.stat(install.CONFIG["pkgs_dir"]).st_mode & 0o2775 == 0o2775
+        assert os.umask(0o022) == 0o002
+    finally:
+        os.umask(previous)
+
+
+# Test that --pkgs-dir is remembered for later runs
+def test_pkgs_dir_is_remembered(conda_home, tmp_path, monkeypatch):
+    from click.testing import CliRunner
+    monkeypatch.delenv("CONDA_SETUP_PKGS_DIR", raising=False)
+    monkeypatch.setenv("CONDA_PKGS_DIRS", "")
+    shared = str(tmp_path / "shared-pkgs")
+    assert CliRunner().invoke(install.main, ["--pkgs-dir", shared, "--gc-pkgs"]).exit_code == 0
+    install.CONFIG["pkgs_dir"] = str(tmp_path / "default-pkgs")
+    result = CliRunner().invoke(install.main, ["--gc-pkgs"])
+    assert result.exit_code == 0 and f"Package cache {shared}:" in result.output
+
+
+# Test that only the marked blocks are removed from an rc file, keeping everything around them and a backup
+def test_remove_rc_block(tmp_path):
+    rc_path = tmp_path / ".bashrc"
+    rc_path.write_text("export A=1\n# >>> conda initialize >>>\neval conda\n# <<< conda initialize <<< trailing\nexport B=2\n"
+                       "  # >>> conda initialize >>> indented, not a marker\n")
+    assert install.remove_rc_block(str(rc_path), "# >>> conda initialize >>>", "# <<< conda initialize <<<")
+    assert rc_path.read_text() == "export A=1\nexport B=2\n  # >>> conda initialize >>> indented, not a marker\n"
+    assert (tmp_path / ".bashrc.conda-setup.bak").read_text().count("eval conda") == 1
+    assert not install.remove_rc_block(str(rc_path), "# >>> conda initialize >>>", "# <<< conda initialize <<<")
+
+
+# Test the installed hook in bash: env vars set on activation go away on deactivate and nested shells keep PATH
+def test_activation_hook_round_trip(conda_home):
+    root = conda_home / "miniconda"
+    install.create_env("work", ["numpy"], capture=True)
+    # An activate.d/deactivate.d pair like the ones compiler and CUDA packages ship
+    for kind, body in (("activate", "export WORK_HOME=/opt/work\n"), ("deactivate", "unset WORK_HOME\n")):
+        (root / "envs" / "work" / "etc" / "conda" / f"{kind}.d").mkdir(parents=True)
+        (root / "envs" / "work" / "etc" / "conda" / f"{kind}.d" / "work.sh").write_text(body)
+    fake_conda = (root / "bin" / "conda").read_text()
+    (root / "bin" / "conda").write_text(fake_conda.replace(
+        "    print(f\"export CONDA_PREFIX='{prefix}'\")\n",
+        "    print(f\"export CONDA_PREFIX='{prefix}'\")\n"
+        "    if os.path.isdir(f'{prefix}/etc/conda/activate.d'): print(f\". '{prefix}/etc/conda/activate.d/work.sh'\")\n",
+    ).replace(
+        "    print(\"export CONDA_SHLVL='0'\")\n",
+        "    print(\"export CONDA_SHLVL='0'\")\n"
+        "    prefix = os.environ['CONDA_PREFIX']\n"
+        "    if os.path.isdir(f'{prefix}/etc/conda/deactivate.d'): print(f\". '{prefix}/etc/conda/deactivate.d/work.sh'\")\n",
+    ))
+    (conda_home / ".bash_profile").write_text(". ~/.bashrc\n")
+    install.install_activation_hook(str(root))
+    assert install.ACTIVATION_BEGIN not in (conda_home / ".bash_profile").read_text()
+
+    script = ('. ~/.bashrc; base_path="$PATH"; conda activate work; echo "active=$WORK_HOME $CONDA_PREFIX"; '
+              'bash -c \'. ~/.bashrc; echo "nested=$CONDA_PREFIX $PATH"\'; conda deactivate; '
+              'echo "after=${WORK_HOME-unset} ${CONDA_PREFIX-unset} ${_CONDA_SETUP_ENV-unset}"; echo "path=$PATH"; echo "base=$base_path"')
+    output = install.subprocess.run(["bash", "-c", script], env=dict(os.environ, PS1="$ "), capture_output=True, text=True, check=True).stdout
+    lines = dict(line.split("=", 1) for line in output.splitlines())
+    work_prefix = str(root / "envs" / "work")
+    assert lines["active"] == f"/opt/work {work_prefix}"
+    nested_prefix, nested_path = lines["nested"].split(" ", 1)
+    assert nested_prefix == work_prefix and nested_path.count(f"{work_prefix}/bin") == 1
+    assert lines["after"] == "unset unset unset"
+    assert f"{work_prefix}/bin" not in lines["path"]
+
+
+# Test that a worker which cannot run conda in-process makes run_in_worker fall back to the CLI
+def test_run_in_worker_falls_back_when_unsupported(tmp_path, monkeypatch):
+    import socketserver
+    import threading
+    import conda_worker
+    # Stand in for a conda release without main_subshell
+    monkeypatch.setitem(sys.modules, "conda.cli.main", None)
+    assert "unsupported" in conda_worker.run_command(["list"])
+
+    monkeypatch.setattr(install, "CONFIG", dict(install.CONFIG, cache_dir=str(tmp_path)))
+    server = socketserver.UnixStreamServer(str(tmp_path / "worker.sock"), conda_worker.CondaRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        assert install.run_in_worker(["list"]) is None
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# Test that an installer without a published checksum is reused only while the server reports it unchanged
+def test_get_installer_revalidates_unpublished(mirror, tmp_path, monkeypatch, capsys):
+    url, payload = mirror
+    monkeypatch.setitem(install.CONFIG, "cache_dir", str(tmp_path / "cache"))
+    monkeypatch.setitem(install.CONFIG, "offline", False)
+    first = install.get_installer(url, kind="micromamba")
+    assert install.get_installer(url, kind="micromamba") == first
+    assert "Using cached installer" in capsys.readouterr().out
+
+    # A new release behind the same URL changes Last-Modified
+    mirror_path = tmp_path / "mirror" / "installer.sh"
+    mirror_path.write_bytes(payload + b"new release")
+    os.utime(mirror_path, (install.time.time() + 10, install.time.time() + 10))
+    second = install.get_installer(url, kind="micromamba")
+    assert second != first and open(second, "rb").read().endswith(b"new release")
+
+    # Without validators the download is trusted for a limited time only
+    monkeypatch.setattr(install, "fetch_validators", lambda url: None)
+    monkeypatch.setitem(install.CONFIG, "installer_max_age_hours", 0)
+    capsys.readouterr()
+    install.get_installer(url, kind="micromamba")
+    assert "Downloading" in capsys.readouterr().out
+
+
+# Test that offline mode never hands a Miniconda script to the micromamba bootstrap or the other way round
+def test_get_installer_offline_matches_kind(mirror, tmp_path, monkeypatch):
+    url, payload = mirror
+    monkeypatch.setitem(install.CONFIG, "cache_dir", str(tmp_path / "cache"))
+    monkeypatch.setitem(install.CONFIG, "offline", False)
+    miniconda = install.get_installer(url)
+    monkeypatch.setitem(install.CONFIG, "offline", True)
+    assert install.get_installer("https://mirror.invalid/Miniconda3.sh") == miniconda
+    with pytest.raises(click.ClickException, match="no verified installer"):
+        install.get_installer("https://mirror.invalid/micromamba", kind="micromamba")
+
+
+# Test that binary relocation keeps every C string the same length and writes a new inode
+def test_relocate_file_binary_padding(tmp_path):
+    old, new = "/opt/envs/old-prefix", "/opt/envs/new"
+    data = b"\x7fELF\0" + old.encode() + b"/lib\0rest\0" + old.encode() + b"\0end"
+    path, link = tmp_path / "libfoo.so", tmp_path / "pkgs-copy.so"
+    path.write_bytes(data)
+    os.link(path, link)
+    install.relocate_file(str(path), old, new, "binary")
+    relocated = path.read_bytes()
+    padding = b"\0" * (len(old) - len(new))
+    assert relocated == b"\x7fELF\0" + new.encode() + b"/lib\0" + padding + b"rest\0" + new.encode() + b"\0" + padding + b"end"
+    assert len(relocated) == len(data)
+    # The package cache copy it was hardlinked to is untouched
+    assert link.read_bytes() == data
+
+
+# Test that text files are rewritten freely but binaries are left alone when the new prefix is longer
+def test_relocate_file_text_and_longer_binary(tmp_path):
+    script, binary = tmp_path / "script", tmp_path / "binary"
+    script.write_text("#!/opt/a/bin/python\nprint('/opt/a')\n")
+    binary.write_bytes(b"/opt/a/lib\0")
+    install.relocate_file(str(script), "/opt/a", "/opt/longer", "text")
+    install.relocate_file(str(binary), "/opt/a", "/opt/longer", "binary")
+    assert script.read_text() == "#!/opt/longer/bin/python\nprint('/opt/longer')\n"
+    assert binary.read_bytes() == b"/opt/a/lib\0"
+
+
+# Test that an import goes back to the original prefix when it is free, and is relocated under a new name
+def test_export_import_round_trip(conda_home, tmp_path):
+    install.create_env("proj", ["numpy"], capture=True)
+    prefix = str(conda_home / "miniconda" / "envs" / "proj")
+    with open(os.path.join(prefix, "bin", "tool"), "w") as f:
+        f.write(f"#!{prefix}/bin/python\n")
+    archive_path = str(tmp_path / "proj.tar.zst")
+    install.export_env("proj", archive_path)
+
+    install.shutil.rmtree(prefix)
+    install.import_env(archive_path)
+    assert open(os.path.join(prefix, "bin", "tool")).read() == f"#!{prefix}/bin/python\n"
+
+    install.import_env(archive_path, "copy")
+    copy_prefix = str(conda_home / "miniconda" / "envs" / "copy")
+    assert open(os.path.join(copy_prefix, "bin", "tool")).read() == f"#!{copy_prefix}/bin/python\n"
+    with pytest.raises(click.ClickException, match="already exists"):
+        install.import_env(archive_path, "copy")